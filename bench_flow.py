@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+#
+# Compares the optical flow engines of process_video.py (--of-engine and
+# --of-dis-preset) on sample videos, to choose a speed/quality point for a
+# deployment. For each engine this reports the throughput of the flow step and
+# how far its output, the blue channel of the preprocessed frames, is from that
+# of Farneback, which the detectors were trained on.
+#
+# Accepts all of the process_video.py arguments (-v or --video-list, --backend,
+# --resize, the --of-* settings), so the comparison is made with the settings of
+# the deployment.
+#
+import copy
+import time
+
+import cv2 as cv
+import numpy as np
+import pandas as pd
+
+import process_video
+from preprocess_engines import DIS_PRESETS, OF_ENGINES, create_engine
+
+
+def argument_parser():
+    parser = process_video.argument_parser()
+
+    group = parser.add_argument_group('benchmark')
+    group.add_argument('--bench-start', type=int, default=0, help='first frame of each video to use. Default is 0')
+    group.add_argument('--bench-frames', type=int, default=100, help='number of consecutive frames of each video to use. Default is 100')
+    group.add_argument('--engines', nargs='+', default=['farneback'] + ['dis:' + p for p in DIS_PRESETS],
+                       help='engines to compare, as ENGINE or dis:PRESET. Farneback is always run as the reference. '
+                            'Default is farneback ' + ' '.join('dis:' + p for p in DIS_PRESETS))
+    group.add_argument('--outfile', help='csv of the results per video and engine')
+    return parser
+
+
+def engine_args(args, spec):
+    args = copy.copy(args)
+    args.of_engine, _, preset = spec.partition(':')
+    if preset:
+        args.of_dis_preset = preset
+    return args
+
+
+def read_frames(args, video_file):
+    video = cv.VideoCapture(video_file)
+    video.set(cv.CAP_PROP_POS_FRAMES, args.bench_start)
+    frames = []
+    for _ in range(args.bench_frames):
+        success, frame = video.read()
+        if not success:
+            break
+        frames.append(frame)
+    return frames
+
+
+# Runs the flow step of one engine on consecutive pairs of `frames`. Returns the
+# blue channel of each pair, as process_video.py would save it, and the time
+# taken per pair. The grayscale (or equalized) frames are prepared beforehand
+# and are not timed.
+def run_engine(args, frames):
+    engine = create_engine(args)
+    if args.of_equalize_luminance:
+        grays = [engine.equalized_gray(engine.upload(frame)) for frame in frames]
+    else:
+        grays = [engine.gray(engine.upload(frame)) for frame in frames]
+
+    # The first pair warms up the engine and is not timed
+    blue = engine.flow(grays[0], grays[1])
+    engine.composite(blue, blue, blue)
+
+    blues = []
+    start = time.perf_counter()
+    for prev, gray in zip(grays, grays[1:]):
+        blue = engine.flow(prev, gray)
+        blues.append(engine.composite(blue, blue, blue)[..., 0])
+    return blues, (time.perf_counter() - start) / len(blues)
+
+
+def main(args):
+    if args.video_list:
+        with open(args.video_list) as f:
+            videos = [line.strip() for line in f if line.strip()]
+    else:
+        videos = [args.video]
+    specs = ['farneback'] + [spec for spec in args.engines if spec != 'farneback']
+
+    rows = []
+    for video_file in videos:
+        frames = read_frames(args, video_file)
+        if len(frames) < 3:
+            print(f'{video_file}: too few frames, skipped')
+            continue
+
+        reference = None
+        for spec in specs:
+            blues, seconds = run_engine(engine_args(args, spec), frames)
+            if reference is None:
+                reference, reference_seconds = blues, seconds
+
+            # Pixel-wise differences, averaged over all pixels of all pairs
+            abs_diff, sq_diff, over_32 = [], [], []
+            for blue, ref in zip(blues, reference):
+                diff = cv.absdiff(blue, ref).astype(np.float32)
+                abs_diff.append(diff.mean())
+                sq_diff.append(np.square(diff).mean())
+                over_32.append(np.mean(diff > 32))
+            rows.append(dict(
+                video=video_file,
+                engine=spec,
+                pairs=len(blues),
+                ms_per_pair=1e3 * seconds,
+                pairs_per_second=1 / seconds,
+                speedup=reference_seconds / seconds,
+                mean_abs_diff=np.mean(abs_diff),
+                rms_diff=np.sqrt(np.mean(sq_diff)),
+                diff_over_32=np.mean(over_32),
+            ))
+            print('{}: {:<14} {:8.1f} ms/pair {:7.1f}x   blue |diff| mean {:5.2f}, rms {:5.2f}, >32 {:6.2%}'.format(
+                video_file, spec, rows[-1]['ms_per_pair'], rows[-1]['speedup'],
+                rows[-1]['mean_abs_diff'], rows[-1]['rms_diff'], rows[-1]['diff_over_32']))
+
+    df = pd.DataFrame(rows)
+    if len(videos) > 1 and len(df):
+        print('\nAll videos:')
+        print(df.groupby('engine', sort=False)[['ms_per_pair', 'speedup', 'mean_abs_diff', 'rms_diff', 'diff_over_32']]
+              .mean().to_string(float_format='{:.3f}'.format))
+    if args.outfile:
+        print('Writing:', args.outfile)
+        df.to_csv(args.outfile, index=False)
+
+
+if __name__ == '__main__':
+    parser = argument_parser()
+    args = parser.parse_args()
+    for spec in args.engines:
+        engine, _, preset = spec.partition(':')
+        if engine not in OF_ENGINES or (preset and (engine != 'dis' or preset not in DIS_PRESETS)):
+            parser.error(f'Error: unknown engine "{spec}"')
+    args = process_video.use_device(args, (args.backend, 0))
+    main(args)
@@ -7,12 +7,16 @@
 
 import os
 import sys
+import numpy as np
 import pandas as pd
 import argparse
+from multiprocessing.pool import ThreadPool
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 import seaborn as sn
-import datetime as dt
+
+import label_manifest
+import weather
 
 
 def get_labelfiles_from_txtdir(target):
@@ -20,29 +24,75 @@ def get_labelfiles_from_txtdir(target):
         with open(target) as f:
             label_files = [x.strip() for x in f.readlines()]
     elif os.path.isdir(target):
-        label_files = [os.path.join(target,x) for x in os.listdir(target) if x.endswith('.txt')]
+        with os.scandir(target) as entries:
+            label_files = [entry.path for entry in entries if entry.name.endswith('.txt')]
     else:
         raise FileNotFoundError(target)
     return label_files
 
 
-def create_df_from_labels(label_files):
-    detect_data = []
+def count_labels(lfile):
+    # same count as len(f.readlines()): one per newline, plus a last line without one.
+    # empty files (null frames) are common, and only need a stat
+    try:
+        if os.stat(lfile).st_size == 0:
+            return 0
+        with open(lfile,'rb') as f:
+            data = f.read()
+    except OSError:
+        print('error:',lfile)
+        return np.nan
+    return data.count(b'\n') + (not data.endswith(b'\n'))
+
+
+def create_df_from_labels(label_files, workers=16):
+    # files are counted in parallel, most of the time goes to waiting on the filesystem
+    counts = np.empty(len(label_files))
+    with ThreadPool(workers) as pool:
+        results = pool.imap(count_labels, label_files, chunksize=256)
+        for i,count in enumerate(tqdm(results, total=len(label_files), desc='Processing Detection DF...')):
+            counts[i] = count
+
+    frames = pd.Index([os.path.splitext(os.path.basename(lfile))[0] for lfile in label_files], name='frame')
+    videos = frames.str.rsplit('_',n=1).str[0] if len(frames) else []
+    if not np.isnan(counts).any():
+        counts = counts.astype(int)
+    df = pd.DataFrame(dict(video=videos, count=counts), index=frames)
+
+    return df
+
+
+def create_df_from_labeldir(target, workers=16, cache=False):
+    # create_df_from_labels for a directory or listfile of label files.
+    # with cache, counts come from a label manifest (see label_manifest.py) saved next to target.
+    # it is used as is while target is unchanged since it was saved, ie no label files were added
+    # or removed, and otherwise updated, re-reading only new or changed label files
+    if not cache:
+        return create_df_from_labels(get_labelfiles_from_txtdir(target), workers)
 
-    for lfile in tqdm(label_files,desc='Processing Detection DF...'):
-        frame_id,_ = os.path.splitext(os.path.basename(lfile))
-        video_id = frame_id.rsplit('_',1)[0]
-        try:
-            with open(lfile) as f:
-                label_count = len(f.readlines())
-        except:
-            print('error:',lfile)
-            label_count = None
-        frame_data = dict(video=video_id, frame=frame_id, count=label_count)
-        detect_data.append(frame_data)
+    manifest_file = target.rstrip(os.sep)+'.manifest.npz'
+    if os.path.isfile(manifest_file) and os.stat(target).st_mtime_ns <= os.stat(manifest_file).st_mtime_ns:
+        manifest = label_manifest.load(manifest_file)
+    else:
+        # detect.py output has no images alongside the labels, so none are looked up
+        manifest = label_manifest.update(manifest_file, get_labelfiles_from_txtdir(target), workers, find_images=False)
+
+    frames = pd.Index(manifest['frame'], name='frame')
+    videos = frames.str.rsplit('_',n=1).str[0] if len(frames) else []
+    return pd.DataFrame(dict(video=videos, count=manifest['count']), index=frames)
+
+
+def create_df_from_detections(detect_file):
+    # one csv or parquet file of detections from detect.py --save-csv/--save-parquet.
+    # frames without detections have a row with an empty class
+    if detect_file.endswith('.parquet'):
+        detections = pd.read_parquet(detect_file, columns=['frame','class'])
+    else:
+        detections = pd.read_csv(detect_file, usecols=['frame','class'])
 
-    df = pd.DataFrame(detect_data)
-    df.set_index('frame', inplace=True)
+    counts = detections.groupby('frame', sort=False)['class'].count()
+    df = pd.DataFrame(dict(video=counts.index.str.rsplit('_',n=1).str[0], count=counts.values), index=counts.index)
+    df.index.name = 'frame'
 
     return df
 
@@ -252,87 +302,35 @@ def quote_video(df):
 
 def add_metadata(df):
 
-    def frameid2timestamp(f):
-        video_id,ms = f.rsplit('_',1) 
-        # example video_id: 20170701145052891 --> 2017-07-01 14:50:52.891
-        ts = dt.datetime.strptime(video_id+'000','%Y%m%d%H%M%S%f')
-        ts = ts + dt.timedelta(milliseconds=int(ms))
-        return ts
-
+    # example frame id: 20170701145052891_1234 --> video 2017-07-01 14:50:52.891, plus 1234 msec
     df.reset_index(inplace=True)
-    df['ts'] = df.frame.apply(frameid2timestamp)
+    video_ms = df.frame.str.rsplit('_',n=1).str
+    df['ts'] = pd.to_datetime(video_ms[0]+'000', format='%Y%m%d%H%M%S%f') + \
+               pd.to_timedelta(video_ms[1].astype(int), unit='ms')
     df.set_index('frame',inplace=True)
     df = df[['video','ts','count']]
     
-    try:
-        df_daily = pd.read_csv('../weather-daily.csv', index_col='datetime', parse_dates=['sunrise','sunset'])
-        df_hourly = pd.read_csv('../weather-hourly.csv', index_col='datetime', parse_dates=['datetime'])
-    except FileNotFoundError:
-        df_daily = pd.read_csv('weather-daily.csv', index_col='datetime', parse_dates=['sunrise','sunset'])
-        df_hourly = pd.read_csv('weather-hourly.csv', index_col='datetime', parse_dates=['datetime'])
-    
-    daycats = ['   morning','  late-morning',' noon','afternoon','late-afternoon']
-    def ts2daycat(ts):
-        date = ts.strftime('%Y-%m-%d')
-        sunrise = df_daily.loc[date].sunrise
-        sunset = df_daily.loc[date].sunset
-        sundiff = sunset-sunrise
-        sunseg = sundiff/len(daycats)
-        cats = ['night']+daycats
-        for i in range(len(cats)):
-            if ts<sunrise+i*sunseg:
-                return cats[i]
-        return 'night'
-
-    def cloudcat(val):
-        val = val/100
-        if val<0.33:
-            return 'clear'
-        elif val<0.66:
-            return 'partly-cloudy'
-        elif val<0.88:
-            return 'mostly-cloudy'
-        else:
-            return 'overcast'
-    def ts2cloudcat(ts,hourly=True):
-        if hourly:
-            ts = ts - dt.timedelta(minutes=ts.minute, 
-                                   seconds=ts.second, 
-                                   microseconds=ts.microsecond)
-            val = df_hourly.loc[ts].cloudcover
-        else:
-            date = ts.strftime('%Y-%m-%d')
-            val = df_daily.loc[date].cloudcover
-        try: return cloudcat(val)
-        except ValueError: 
-            print('Warning: Duplicate "{ts}" ts entry. Using first found instance.')
-            return cloudcat(val.iloc[0])
-
-    def mooncat(val):
-        val = val*100
-        if val<12.5: return 'new'
-        elif val<12.5*2: return 'crescent'
-        elif val<12.5*3: return 'quarter'
-        elif val<12.5*4: return 'gibbous'
-        elif val<12.5*5: return 'full'
-        elif val<12.5*6: return 'gibbous'
-        elif val<12.5*7: return 'quarter'
-        else: return 'crescent'
-    def ts2mooncat(ts):
-        date = ts.strftime('%Y-%m-%d')
-        val = df_daily.loc[date].moonphase
-        return mooncat(val)
-    
-    df = df.assign(cloudcat = df.ts.apply(ts2cloudcat),
-                   daycat   = df.ts.apply(ts2daycat),
-                   mooncat  = df.ts.apply(ts2mooncat))
+    if os.path.isfile('../weather-hourly.csv'):
+        store = weather.load_weather('../weather-hourly.csv', '../weather-daily.csv')
+    else:
+        store = weather.load_weather('weather-hourly.csv', 'weather-daily.csv')
+
+    # join each frame to the weather of its hour and day
+    wx = weather.lookup(store, df.ts)
+    cloudcat = weather.cloudcat(wx.cloudcover)
+    mooncat = weather.mooncat(wx.moonphase)
+    daycat = weather.daycat(df.ts, wx.sunrise, wx.sunset)
+
+    df = df.assign(cloudcat = cloudcat,
+                   daycat   = daycat,
+                   mooncat  = mooncat)
     return df
 
     
 
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('DETECTIONS', help='Accepts a directory of txt label files, or a text file listing txt label files')
+    parser.add_argument('DETECTIONS', help='Accepts a directory of txt label files, a text file listing txt label files, or a detect.py --save-csv/--save-parquet file')
     parser.add_argument('--input-labels', help='Compares DETECTIONS against known labels. Accepts a directory of txt label files, or a text file listing txt label files')
     parser.add_argument('--zooniverse', action='store_true', help='Compares DETECTIONS against zooniverse csv')
     parser.add_argument('--outdir','-o')
@@ -340,12 +338,17 @@ if __name__=='__main__':
     parser.add_argument('--summary', action='store_true')
     parser.add_argument('--metadata', action='store_true')
     parser.add_argument('--outfile')
+    parser.add_argument('--workers', type=int, default=16, help='threads counting label files. Default is 16')
+    parser.add_argument('--cache', action='store_true', help='keep label counts in a DETECTIONS.manifest.npz label manifest, reused while DETECTIONS is unchanged and otherwise updated incrementally')
     args = parser.parse_args()
     
     # create detections dataframe: video, frame, model_count
-    label_files = get_labelfiles_from_txtdir(args.DETECTIONS)
+    if args.DETECTIONS.endswith(('.csv','.parquet')):
+        df_detect = create_df_from_detections(args.DETECTIONS)
+    else:
+        df_detect = create_df_from_labeldir(args.DETECTIONS, args.workers, args.cache)
     
-    if not label_files:
+    if not len(df_detect):
         print('Error: No Frames found.')
         if args.outdir:
             fname_full = args.outfile or 'results.full.csv'
@@ -355,8 +358,6 @@ if __name__=='__main__':
                 header='video,frame,ts,count,cloudcat,daycat,mooncat'
                 f.write(header+'\n')
         sys.exit('DONE')
-    
-    df_detect = create_df_from_labels(label_files)
  
     if args.outdir:
         os.makedirs(args.outdir,exist_ok=True)
@@ -0,0 +1,141 @@
+#
+# Image sinks for the frames written by process_video.py.
+#
+# Encoding a frame and writing it to shared scratch storage can take longer
+# than preprocessing it, so frames are written on a pool of background threads
+# (cv.imencode and file I/O release the GIL). At most `max_pending` frames are
+# queued; past that, write() blocks until a frame has been written, which
+# bounds memory use if the storage falls behind.
+#
+# With --archive, the frames saved under each directory are packed into a
+# single uncompressed zip archive per video rather than one file per frame,
+# which is far kinder to shared filesystems. Frames are looked up by name in
+# the archive's central directory, e.g. VIDEONAME.zip/VIDEONAME_1234.jpg.
+#
+import concurrent.futures
+import os
+import threading
+import zipfile
+
+import cv2 as cv
+
+
+IMAGE_FORMATS = ('jpg', 'png', 'webp')
+
+
+def add_writer_arguments(group):
+    group.add_argument('--image-format', choices=IMAGE_FORMATS, default='jpg',
+                       help='format of saved frames. Default is "jpg"')
+    group.add_argument('--jpeg-quality', type=int, default=95,
+                       help='quality (0-100) of saved jpg and webp frames. Default is 95')
+    group.add_argument('--writer-threads', type=int, default=4,
+                       help='number of threads writing frames. Use 0 to write frames inline. Default is 4')
+    group.add_argument('--writer-queue', type=int, default=64,
+                       help='maximum number of frames waiting to be written. Default is 64')
+    group.add_argument('--archive', action='store_true',
+                       help='pack the frames saved by --save-original and --save-preprocessed into '
+                            'one VIDEONAME.zip per directory instead of one file per frame')
+
+
+def create_writer(args, archive=None):
+    return FrameWriter(
+        threads=args.writer_threads,
+        max_pending=args.writer_queue,
+        image_format=args.image_format,
+        quality=args.jpeg_quality,
+        archive=archive,
+    )
+
+
+# Joins the part archives written by several writers into a single archive at
+# `path`, in the order given. Missing parts (writers that saved no frames) are
+# skipped. The images are already compressed, so the members are copied as is.
+def merge_archives(path, parts):
+    parts = [part for part in parts if os.path.exists(part)]
+    if len(parts) == 1:
+        os.replace(parts[0], path)
+        return
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as merged:
+        for part in parts:
+            with zipfile.ZipFile(part) as zf:
+                for info in zf.infolist():
+                    merged.writestr(info, zf.read(info))
+            os.remove(part)
+
+
+class FrameWriter:
+    def __init__(self, threads=4, max_pending=64, image_format='jpg', quality=95, archive=None):
+        self.ext = '.' + image_format
+        if image_format == 'jpg':
+            self.params = [cv.IMWRITE_JPEG_QUALITY, quality]
+        elif image_format == 'webp':
+            self.params = [cv.IMWRITE_WEBP_QUALITY, quality]
+        else:
+            self.params = []
+
+        # If `archive` is set, images are packed into the archive of that name
+        # in each directory rather than written as files
+        self.archive = archive
+        self.archives = {}
+        self.lock = threading.Lock()
+
+        self.executor = None
+        if threads > 0:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+            self.slots = threading.BoundedSemaphore(max_pending)
+        self.errors = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Queue `image` to be written as `name` (without extension) under
+    # `directory`. The image must not be modified afterwards.
+    def write(self, directory, name, image):
+        if self.archive:
+            task = (self._write_member, os.path.join(directory, self.archive), name + self.ext, image)
+        else:
+            task = (self._write_file, os.path.join(directory, name + self.ext), image)
+
+        if self.executor is None:
+            task[0](*task[1:])
+            return
+
+        self.slots.acquire()
+        future = self.executor.submit(*task)
+        future.add_done_callback(self._done)
+
+    def _write_file(self, path, image):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not cv.imwrite(path, image, self.params):
+            raise IOError(f'Could not write {path}')
+
+    def _write_member(self, path, member, image):
+        success, data = cv.imencode(self.ext, image, self.params)
+        if not success:
+            raise IOError(f'Could not encode {path}/{member}')
+
+        # Only the append to the archive is serialized, not the encoding
+        with self.lock:
+            if path not in self.archives:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self.archives[path] = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED)
+            self.archives[path].writestr(member, data.tobytes())
+
+    def _done(self, future):
+        self.slots.release()
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+
+    # Wait for all queued frames to be written
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        for zf in self.archives.values():
+            zf.close()
+        self.archives = {}
+        if self.errors:
+            raise self.errors[0]
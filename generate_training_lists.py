@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 import argparse
+import collections
 import os
 import random
 
+import label_manifest
+
 
 parser = argparse.ArgumentParser()
 parser.add_argument('SRC')
@@ -14,33 +17,47 @@ parser.add_argument('--seed', default=random.randint(0,999999), type=int)
 parser.add_argument('--outdir','-o', default='training-data/EXAMPLE_DIR')
 parser.add_argument('--limit', nargs=2, metavar=('VIDEO','FRAMESLIMIT'), action='append', default=[])
 parser.add_argument('--dotdotslash', action='store_true')
+parser.add_argument('--manifest', help='label manifest file, reused between runs. Default is SRC/.label_manifest.npz')
+parser.add_argument('--rescan', action='store_true', help='update the label manifest, re-reading changed labels, even if it exists')
+parser.add_argument('--workers', default=16, type=int, help='threads for stat calls while scanning. Default is 16')
 
 args = parser.parse_args()
 
 print(f'Seed: {args.seed}')
 random.seed(args.seed)
 
-label_files = []
-for (root, dirs, files) in os.walk(args.SRC):
-    for f in files:
-        if f.endswith('.txt') and '_' in f:
-            videoid = f.rsplit('_',1)[0]
-            label_file = os.path.join(root, f)
-            bytes = os.path.getsize(label_file)
-            count = round(bytes/34)
-            image_file = label_file.replace('.txt','.jpg').replace('labels/','images/')#.replace('negatives/','')
-            if not os.path.isfile(image_file):
-                image_file = None
-                
-            label_files.append(dict(videoid=videoid, label_file=label_file, count=count, image_file=image_file))
-
-
+# The label manifest (see label_manifest.py) holds each label's image path and
+# exact fish count. Scanning SRC is the slow part on a shared filesystem, so the
+# manifest is saved and reused as is by later runs with other ratios and seeds.
+# With --rescan, it is updated, re-reading only the labels that changed.
+manifest_file = args.manifest or os.path.join(args.SRC, '.label_manifest.npz')
+if os.path.isfile(manifest_file) and not args.rescan:
+    print(f'Reading {manifest_file}')
+    manifest = label_manifest.load(manifest_file)
+else:
+    walked = []
+    for (root, dirs, files) in os.walk(args.SRC):
+        for f in files:
+            if f.endswith('.txt') and '_' in f:
+                walked.append(os.path.join(root, f))
+    print(f'Writing {manifest_file}')
+    manifest = label_manifest.update(manifest_file, walked, args.workers)
+
+label_files = [dict(videoid=os.path.basename(label_file).rsplit('_',1)[0], label_file=label_file, count=int(count), image_file=image_file or None)
+               for label_file,image_file,count in zip(manifest['label_file'].tolist(), manifest['image_file'].tolist(), manifest['count'].tolist())]
+
+# group by video in one pass, keeping scan order within each video
+withfish = collections.defaultdict(list)
+sansfish = collections.defaultdict(list)
+missing_jpgs = collections.defaultdict(list)
+for d in label_files:
+    if d['image_file'] is None:
+        missing_jpgs[d['videoid']].append(d)
+    elif d['count']!=0:
+        withfish[d['videoid']].append(d)
+    else:
+        sansfish[d['videoid']].append(d)
 videoids = sorted({d['videoid'] for d in label_files})
-withfish = [d for d in label_files if d['count']!=0 and d['image_file']]
-sansfish = [d for d in label_files if d['count']==0 and d['image_file']]
-missing_jpgs = [d for d in label_files if d['image_file'] is None]
-
-assert len(withfish)+len(sansfish) == len([d for d in label_files if d['image_file']])
 
 def split(data, train_ratio, val_ratio, test_ratio=0, shuffle=False):
     assert 0 < train_ratio < 1
@@ -61,16 +78,16 @@ def split(data, train_ratio, val_ratio, test_ratio=0, shuffle=False):
 training_set = []
 validation_set = []
 test_set = []
-missing_set = [d['label_file'] for d in missing_jpgs]
+missing_set = [d['label_file'] for d in label_files if d['image_file'] is None]
 fishcount_total = 0
 
 print(f'           video-id:  FILESET: <num-o-files> (withfish+sansfish)')
 for videoid in videoids:
     # on a per-video basis evenly split up frames with and without fish into
-    video_fishcount = sum([d['count'] for d in withfish if d['videoid']==videoid])
-    withdata = [d['image_file'] for d in withfish if d['videoid']==videoid]
-    sansdata = [d['image_file'] for d in sansfish if d['videoid']==videoid]
-    missingjpg_count = sum([1 for d in missing_jpgs if d['videoid']==videoid])
+    video_fishcount = sum([d['count'] for d in withfish[videoid]])
+    withdata = [d['image_file'] for d in withfish[videoid]]
+    sansdata = [d['image_file'] for d in sansfish[videoid]]
+    missingjpg_count = len(missing_jpgs[videoid])
     
     random.shuffle(withdata)
     random.shuffle(sansdata)
@@ -82,7 +99,8 @@ for videoid in videoids:
         sans_ratio = len(sansdata)/(len(withdata)+len(sansdata))
         withdata = withdata[:round(max_lim*with_ratio)]
         sansdata = sansdata[:round(max_lim*sans_ratio)]
-        video_fishcount = sum([d['count'] for d in withfish if d['videoid']==videoid and d['image_file'] in withdata])
+        kept = set(withdata)
+        video_fishcount = sum([d['count'] for d in withfish[videoid] if d['image_file'] in kept])
     
     if args.neg_ratio >= 0:
         neg_ratio = round(len(withdata)*args.neg_ratio)
@@ -139,7 +157,7 @@ with open(test_out2, 'w') as o:
     o.writelines('\n'.join(frame_ids))
     
 missing_out = os.path.join(args.outdir,'missing_jpg.list')
-print(f'Writing {missing_out} (wc:{len(missing_jpgs)})')    
+print(f'Writing {missing_out} (wc:{len(missing_set)})')    
 with open(missing_out, 'w') as o:
     o.writelines('\n'.join(missing_set))
 
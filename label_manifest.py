@@ -0,0 +1,115 @@
+#
+# Columnar manifest of yolo label files, so label I/O is paid once per dataset
+# rather than once per tool and per epoch.
+#
+# A manifest is an npz file of parallel arrays, one entry per label file:
+#
+#   frame       -- frame id, the label file name without extension
+#   label_file  -- label file path
+#   image_file  -- matching image path (labels/ -> images/, .txt -> .jpg), or ''
+#   count       -- exact box count, the same as len(f.readlines())
+#   size, mtime -- label file size and mtime when it was read
+#   offsets     -- the boxes of entry i are boxes[offsets[i]:offsets[i+1]]
+#   boxes       -- float32 rows of (class, x, y, w, h)
+#
+# It has no dependency beyond numpy, so it can also be read directly with
+# np.load (eg by the classifier's HerringrunnerDataset).
+#
+import os
+import uuid
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+
+def image_for_label(label_file):
+    return label_file.replace('.txt','.jpg').replace('labels/','images/')
+
+
+def read_label(label_file):
+    with open(label_file) as f:
+        lines = f.readlines()
+    rows = [line.split()[:5] for line in lines]
+    boxes = np.array([row for row in rows if len(row) == 5], dtype=np.float32).reshape(-1, 5)
+    return len(lines), boxes
+
+
+# Stats a label file and, with find_images, finds its image. The label itself
+# is only read if it is not `known` with the same (size, mtime).
+def scan_label(label_file, known=None, find_images=True):
+    try:
+        st = os.stat(label_file)
+    except OSError:
+        print('error:', label_file)
+        return None
+    image_file = image_for_label(label_file) if find_images else ''
+    if image_file and not os.path.isfile(image_file):
+        image_file = ''
+    if known == (st.st_size, st.st_mtime):
+        return image_file, st.st_size, st.st_mtime, None
+    return image_file, st.st_size, st.st_mtime, read_label(label_file)
+
+
+def load(manifest_file):
+    with np.load(manifest_file) as m:
+        return dict(m)
+
+
+def boxes(manifest, i):
+    return manifest['boxes'][manifest['offsets'][i]:manifest['offsets'][i+1]]
+
+
+# Builds the manifest of `label_files`, reusing the entries of the manifest
+# already saved at `manifest_file` for files whose size and mtime are
+# unchanged. Files are stat'ed and read on `workers` threads. Missing label
+# files are left out. The updated manifest is saved and returned. Without
+# find_images, image paths are not looked up and are left '', which saves a
+# stat per label where there are no images, eg detect.py output.
+def update(manifest_file, label_files, workers=16, find_images=True):
+    old, known = None, {}
+    if os.path.isfile(manifest_file):
+        old = load(manifest_file)
+        known = {label_file: i for i, label_file in enumerate(old['label_file'].tolist())}
+
+    def scan(label_file):
+        i = known.get(label_file)
+        return scan_label(label_file, None if i is None else (old['size'][i], old['mtime'][i]), find_images)
+
+    with ThreadPool(workers) as pool:
+        results = pool.map(scan, label_files, chunksize=256)
+
+    entries, reread = [], 0
+    for label_file, result in zip(label_files, results):
+        if result is None:
+            continue
+        image_file, size, mtime, parsed = result
+        if parsed is None:
+            i = known[label_file]
+            parsed = old['count'][i], boxes(old, i)
+        else:
+            reread += 1
+        entries.append((label_file, image_file, size, mtime) + tuple(parsed))
+    print(f'label manifest: {len(entries)} labels, {reread} read')
+
+    manifest = dict(
+        frame=np.array([os.path.splitext(os.path.basename(e[0]))[0] for e in entries], dtype=str),
+        label_file=np.array([e[0] for e in entries], dtype=str),
+        image_file=np.array([e[1] for e in entries], dtype=str),
+        size=np.array([e[2] for e in entries], dtype=np.int64),
+        mtime=np.array([e[3] for e in entries], dtype=np.float64),
+        count=np.array([e[4] for e in entries], dtype=np.int64),
+        offsets=np.cumsum([0] + [len(e[5]) for e in entries]).astype(np.int64),
+        boxes=np.concatenate([e[5] for e in entries]) if entries else np.zeros((0, 5), np.float32),
+    )
+
+    # Written to a temporary file and renamed into place, so that readers never
+    # see a partly written manifest
+    tmp_file = f'{manifest_file}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, **manifest)
+        os.replace(tmp_file, manifest_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return manifest
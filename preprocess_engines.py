@@ -0,0 +1,265 @@
+#
+# Frame preprocessing engines for process_video.py.
+#
+# Each engine implements the same hybrid-motion preprocessing steps (background
+# subtraction, grayscale conversion, optical flow) on a particular backend. The
+# composite BGR image produced by every engine has the same layout:
+#
+#   blue  -- opened optical flow visualization, as grayscale
+#   green -- foreground mask from background subtraction
+#   red   -- grayscale frame
+#
+# Images passed between engine methods are backend-native (cv.cuda_GpuMat for
+# the CUDA engine, numpy arrays for the CPU engine). Only `composite()` returns
+# a host numpy array.
+#
+# The optical flow is computed by Farneback's algorithm, or with --of-engine dis
+# by OpenCV's much faster DIS (dense inverse search) at one of its presets. DIS
+# has no CUDA implementation, so the CUDA engine brings the two grayscale frames
+# back to the host for it and uploads the flow again.
+#
+import cv2 as cv
+import numpy as np
+
+
+BACKENDS = ('cuda', 'cpu')
+OF_ENGINES = ('farneback', 'dis')
+DIS_PRESETS = ('ultrafast', 'fast', 'medium')
+
+
+# Fraction of a composite image's pixels that are foreground in its green
+# (background subtraction mask) channel. The mask is thresholded at half
+# intensity so that a composite read back from a JPEG gives the same fraction
+# as the one it was saved from.
+def foreground_fraction(composite):
+    mask = composite[..., 1]
+    return np.count_nonzero(mask > 127) / mask.size
+
+
+def create_engine(args):
+    if args.backend == 'cuda':
+        return CudaEngine(args)
+    elif args.backend == 'cpu':
+        return CpuEngine(args)
+    else:
+        raise ValueError(f'Unknown backend "{args.backend}"')
+
+
+def create_dis(args):
+    preset = getattr(cv, 'DISOPTICAL_FLOW_PRESET_' + args.of_dis_preset.upper())
+    return cv.DISOpticalFlow_create(preset)
+
+
+class CudaEngine:
+    def __init__(self, args):
+        self.args = args
+        self.stream = cv.cuda_Stream()
+
+        # Create the optical flow calculator
+        if args.of_engine == 'dis':
+            self.flowengine = create_dis(args)
+        else:
+            self.flowengine = cv.cuda_FarnebackOpticalFlow.create(
+                args.of_levels,
+                args.of_pyr_scale,
+                False,
+                args.of_winsize,
+                args.of_iterations,
+                args.of_poly_n,
+                args.of_poly_sigma,
+                0
+            )
+
+        # Create the opening filter
+        kernel = cv.getStructuringElement(cv.MORPH_RECT, (7, 7))
+        self.filter = cv.cuda.createMorphologyFilter(cv.MORPH_OPEN, cv.CV_8UC4, kernel)
+
+        self.reset()
+
+    def reset(self):
+        # Create the background subtractor
+        self.bgsub = cv.cuda.createBackgroundSubtractorMOG2(
+            history=self.args.bg_history,
+            varThreshold=self.args.bg_var_threshold,
+            detectShadows=False
+        )
+
+        # If --of-history is passed, we will use the flow from the previous
+        # frame to inform the flow in this frame.
+        self.last_flow = None
+
+    def upload(self, frame_local):
+        # Upload the frame to the device
+        frame = cv.cuda_GpuMat(frame_local.shape[0], frame_local.shape[1], cv.CV_8UC3)
+        frame.upload(frame_local, stream=self.stream)
+
+        # Resize the frame if necessary
+        if self.args.resize:
+            frame = cv.cuda.resize(frame, tuple(self.args.resize), stream=self.stream)
+        return frame
+
+    def foreground(self, frame):
+        # Apply background subtraction to determine the mask
+        return self.bgsub.apply(frame, -1, stream=self.stream)
+
+    def gray(self, frame):
+        return cv.cuda.cvtColor(frame, cv.COLOR_BGR2GRAY, stream=self.stream)
+
+    def equalized_gray(self, frame):
+        # Equalize the luminance histogram of the image
+        stream = self.stream
+        y, u, v = cv.cuda.split(cv.cuda.cvtColor(frame, cv.COLOR_BGR2YUV, stream=stream), stream=stream)
+        y = cv.cuda.equalizeHist(y, stream=stream)
+
+        eqframe = cv.cuda_GpuMat(y.size(), cv.CV_8UC3)
+        cv.cuda.merge((y, u, v), eqframe, stream=stream)
+        eqframe = cv.cuda.cvtColor(eqframe, cv.COLOR_YUV2RGB,
+                                   stream=stream)  # no direct YUV2GRAY
+        eqframe = cv.cuda.cvtColor(eqframe, cv.COLOR_RGB2GRAY,
+                                   stream=stream)
+        return eqframe
+
+    def flow(self, prev, frame):
+        stream = self.stream
+
+        # Compute optical flow between current frame and previous
+        if self.args.of_engine == 'dis':
+            flow = self.host_flow(prev, frame)
+        else:
+            flow = self.flowengine.calc(prev, frame, self.last_flow, stream=stream)
+            if self.args.of_history:
+                self.last_flow = flow
+
+        # Visualize the flow in color
+        x, y = cv.cuda.split(flow, stream=stream)
+        mag, ang = cv.cuda.cartToPolar(x, y, stream=stream)
+
+        c = cv.cuda_GpuMat(frame.size(), cv.CV_32FC1, 255 / (2*np.pi))
+        hue = cv.cuda.multiply(c, ang, stream=stream)
+        sat = cv.cuda_GpuMat(frame.size(), cv.CV_32FC1, 255)
+        val = cv.cuda.normalize(mag, 0, 255, cv.NORM_MINMAX, -1, stream=stream)
+
+        hsv = cv.cuda_GpuMat(frame.size(), cv.CV_32FC3)
+        cv.cuda.merge((hue, sat, val), hsv, stream=stream)
+
+        # Convert to BGRA
+        bgr = cv.cuda.cvtColor(hsv, cv.COLOR_HSV2BGR, stream=stream)
+        bgra = cv.cuda.cvtColor(bgr, cv.COLOR_BGR2BGRA, stream=stream)
+
+        # Apply an opening operator
+        x = cv.cuda_GpuMat(frame.size(), cv.CV_8UC4)
+        bgra.convertTo(cv.CV_8UC4, x)
+        bgra = self.filter.apply(x)
+
+        # Convert back to grayscale
+        return cv.cuda.cvtColor(bgra, cv.COLOR_BGRA2GRAY, stream=stream)
+
+    def host_flow(self, prev, frame):
+        # DIS runs on the host. Its previous flow, kept on the host, is used
+        # as the initial flow with --of-history.
+        prev_local = prev.download(stream=self.stream)
+        frame_local = frame.download(stream=self.stream)
+        self.stream.waitForCompletion()
+        flow_local = self.flowengine.calc(prev_local, frame_local, self.last_flow)
+        if self.args.of_history:
+            self.last_flow = flow_local
+
+        flow = cv.cuda_GpuMat(flow_local.shape[0], flow_local.shape[1], cv.CV_32FC2)
+        flow.upload(flow_local, stream=self.stream)
+        return flow
+
+    def composite(self, blue_channel, green_channel, red_channel):
+        # Combine the channels
+        combined = cv.cuda_GpuMat(blue_channel.size(), cv.CV_8UC3)
+        cv.cuda.merge((
+            blue_channel,
+            green_channel,
+            red_channel,
+        ), combined, stream=self.stream)
+
+        # Download the combined image from the device
+        output = combined.download(stream=self.stream)
+
+        # Wait for completion of the stream, after which point the finished
+        # image should be in the `output` array.
+        self.stream.waitForCompletion()
+        return output
+
+
+class CpuEngine:
+    def __init__(self, args):
+        self.args = args
+        self.kernel = cv.getStructuringElement(cv.MORPH_RECT, (7, 7))
+        self.flowengine = create_dis(args) if args.of_engine == 'dis' else None
+        self.reset()
+
+    def reset(self):
+        # Create the background subtractor
+        self.bgsub = cv.createBackgroundSubtractorMOG2(
+            history=self.args.bg_history,
+            varThreshold=self.args.bg_var_threshold,
+            detectShadows=False
+        )
+        self.last_flow = None
+
+    def upload(self, frame_local):
+        # Nothing to upload, but we still may need to resize
+        if self.args.resize:
+            return cv.resize(frame_local, tuple(self.args.resize))
+        return frame_local
+
+    def foreground(self, frame):
+        return self.bgsub.apply(frame, learningRate=-1)
+
+    def gray(self, frame):
+        return cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+
+    def equalized_gray(self, frame):
+        y, u, v = cv.split(cv.cvtColor(frame, cv.COLOR_BGR2YUV))
+        y = cv.equalizeHist(y)
+        eqframe = cv.cvtColor(cv.merge((y, u, v)), cv.COLOR_YUV2RGB)
+        return cv.cvtColor(eqframe, cv.COLOR_RGB2GRAY)
+
+    def flow(self, prev, frame):
+        args = self.args
+
+        # As with the CUDA engine, the previous Farneback flow is only passed in
+        # as the output buffer; OPTFLOW_USE_INITIAL_FLOW is not set. DIS uses
+        # it as the initial flow.
+        if self.flowengine is not None:
+            flow = self.flowengine.calc(prev, frame, self.last_flow)
+        else:
+            flow = cv.calcOpticalFlowFarneback(
+                prev, frame, self.last_flow,
+                args.of_pyr_scale,
+                args.of_levels,
+                args.of_winsize,
+                args.of_iterations,
+                args.of_poly_n,
+                args.of_poly_sigma,
+                0
+            )
+        if args.of_history:
+            self.last_flow = flow
+
+        # Visualize the flow in color
+        mag, ang = cv.cartToPolar(flow[..., 0], flow[..., 1])
+        hue = ang * np.float32(255 / (2*np.pi))
+        sat = np.full_like(hue, 255)
+        val = cv.normalize(mag, None, 0, 255, cv.NORM_MINMAX)
+        bgr = cv.cvtColor(cv.merge((hue, sat, val)), cv.COLOR_HSV2BGR)
+
+        # Convert to 8 bits, saturating as the CUDA engine's convertTo does.
+        # The float HSV2BGR conversion gives negative values for strong flow,
+        # which must become 0, not their absolute value.
+        bgr = np.clip(bgr, 0, 255).round().astype(np.uint8)
+
+        # Apply an opening operator. The morphology is per-channel, so the
+        # alpha channel used by the CUDA filter can be skipped here.
+        bgr = cv.morphologyEx(bgr, cv.MORPH_OPEN, self.kernel)
+
+        # Convert back to grayscale
+        return cv.cvtColor(bgr, cv.COLOR_BGR2GRAY)
+
+    def composite(self, blue_channel, green_channel, red_channel):
+        return cv.merge((blue_channel, green_channel, red_channel))
@@ -6,24 +6,35 @@
 # see the README file for full details.
 #
 import argparse
+import collections
+import concurrent.futures
 import configparser
+import copy
 import csv
 import functools
 import json
 import multiprocessing
 import os
+import queue
 import shutil
 import tempfile
+import time
 import datetime as dt
 
 import cv2 as cv
 import numpy as np
 import tqdm
 
+from frame_writers import add_writer_arguments, create_writer, merge_archives
+from preprocess_engines import BACKENDS, DIS_PRESETS, OF_ENGINES, create_engine, foreground_fraction
+
 
 def argument_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-v', '--video', required=True)
+    videos = parser.add_mutually_exclusive_group(required=True)
+    videos.add_argument('-v', '--video')
+    videos.add_argument('--video-list', help='file listing one video per line. Each video is processed '
+                        'whole by a persistent worker, and outputs go to a VIDEONAME subdirectory of each --save-* directory')
     parser.add_argument('--progress', action='store_true')
     parser.add_argument('--frame-list', action='append')
     parser.add_argument('--afr', help='file with frame-rates per month. Mutually exclusive with --frame-list')  # sbatchelder 2022-06-01
@@ -31,12 +42,27 @@ def argument_parser():
     group = parser.add_argument_group('acceleration')
     parser.add_argument('-n', '--num-cores', type=int, default=1)
     parser.add_argument('--ramdisk', action='store_true')
+    group.add_argument('--backend', choices=BACKENDS, default='cuda',
+                       help='device used for preprocessing and detection. Default is "cuda"')
+    group.add_argument('--lazy-pairs', action='store_true',
+                       help='only convert the frames of each saved (previous, current) pair for optical flow')
+    group.add_argument('--workers-per-gpu', type=int, default=1,
+                       help='maximum number of --num-cores workers sharing a GPU. Default is 1')
+    group.add_argument('--cpu-workers', type=int, default=0,
+                       help='number of CPU workers to run alongside the GPU workers. Default is 0')
+    group.add_argument('--max-priming-overhead', type=float, default=0.1,
+                       help='maximum fraction of the video re-processed to prime the background subtractor '
+                            'of each work unit. Fewer work units are used to stay below it. Default is 0.1')
+    group.add_argument('--calibrate-frames', type=int, default=20,
+                       help='number of frames timed on each device to size its work units. '
+                            'Use 0 to split the video evenly. Default is 20')
 
     group = parser.add_argument_group('output')
     group.add_argument('--save-original')
     group.add_argument('--save-preprocessed')
     group.add_argument('--save-detection-data')
     group.add_argument('--save-detection-image')
+    add_writer_arguments(group)
 
     group = parser.add_argument_group('preprocessing')
     group.add_argument('--resize', nargs=2, type=int)
@@ -50,8 +76,14 @@ def argument_parser():
     group.add_argument('--of-equalize-luminance', action='store_true')
     group.add_argument('--of-history', action='store_true')
     group.add_argument('--of-use-angle', action='store_true')
-
-    # Values here are from Fish-Abundance, in comments are OpenCV defaults
+    group.add_argument('--of-engine', choices=OF_ENGINES, default='farneback',
+                       help='optical flow algorithm. "dis" is much faster, especially on CPU, '
+                            'see bench_flow.py. Default is "farneback"')
+    group.add_argument('--of-dis-preset', choices=DIS_PRESETS, default='medium',
+                       help='speed/quality preset of --of-engine dis. Default is "medium"')
+
+    # Farneback parameters. Values here are from Fish-Abundance, in comments
+    # are OpenCV defaults
     group.add_argument('--of-pyr-scale', type=float, default=0.95)  # 0.5
     group.add_argument('--of-levels', type=int, default=10)  # 3
     group.add_argument('--of-winsize', type=int, default=15)  # 7
@@ -64,13 +96,23 @@ def argument_parser():
     group.add_argument('--nn-nms', type=float, default=0.4)
     group.add_argument('--nn-weights')
     group.add_argument('--nn-config')
-    # TODO --nn-onnx
+    group.add_argument('--nn-onnx', help='yolov5 model exported by export.py --include onnx, used instead of --nn-weights')
+    group.add_argument('--nn-size', nargs=2, type=int, default=[640, 640], metavar=('WIDTH', 'HEIGHT'),
+                       help='input size of the --nn-onnx model. Default is 640 640')
+    group.add_argument('--motion-gate', type=float, metavar='FRACTION',
+                       help='skip the network on frames whose foreground mask covers less than FRACTION of '
+                            'the frame, recording no detections for them. See tune_motion_gate.py')
+    group.add_argument('--nn-batch', type=int, default=1,
+                       help='number of frames per forward pass of the --nn-onnx model, which must have been '
+                            'exported with --dynamic if more than 1. Default is 1')
 
     return parser
 
 
 def num_gpus():
-    ordinals = os.environ.get('GPU_DEVICE_ORDINAL', '').split(',')
+    # Only read the environment, so the parent process never initializes CUDA
+    # before forking its workers
+    ordinals = os.environ.get('GPU_DEVICE_ORDINAL', os.environ.get('CUDA_VISIBLE_DEVICES', '')).split(',')
     return len([o for o in ordinals if o != ''])
 
 
@@ -79,22 +121,45 @@ def assign_gpu(n):
     cv.cuda.setDevice(n)
 
 
+# Returns a copy of args for a worker running on `device`, a (backend, gpu)
+# pair, after selecting its GPU
+def use_device(args, device):
+    args = copy.copy(args)
+    args.backend, gpu = device
+
+    # Assign a GPU to us
+    if args.backend == 'cuda':
+        try: assign_gpu(gpu)
+        except Exception as e:
+            print("ASSIGN_GPU(n):",type(e),e)
+
+    return args
+
+
 def load_network(worker_num, args):
-    if not (args.nn_weights and args.nn_config):
+    if args.nn_onnx:
+        # The input size of an exported yolov5 model is fixed at export time
+        net = cv.dnn.readNetFromONNX(args.nn_onnx)
+        nn_size = tuple(args.nn_size)
+    elif args.nn_weights and args.nn_config:
+        net = cv.dnn.readNet(args.nn_weights, args.nn_config, 'darknet')
+
+        # Determine the input image size the network expects
+        config = configparser.ConfigParser(strict=False)
+        config.read(args.nn_config)
+        nn_size = (
+            int(config['net']['width']),
+            int(config['net']['height'])
+        )
+    else:
         return None, None
-        # TODO --nn-onnx
 
-    net = cv.dnn.readNet(args.nn_weights, args.nn_config, 'darknet')
-    net.setPreferableBackend(cv.dnn.DNN_BACKEND_CUDA)
-    net.setPreferableTarget(cv.dnn.DNN_TARGET_CUDA)
-
-    # Determine the input image size the network expects
-    config = configparser.ConfigParser(strict=False)
-    config.read(args.nn_config)
-    nn_size = (
-        int(config['net']['width']),
-        int(config['net']['height'])
-    )
+    if args.backend == 'cuda':
+        net.setPreferableBackend(cv.dnn.DNN_BACKEND_CUDA)
+        net.setPreferableTarget(cv.dnn.DNN_TARGET_CUDA)
+    else:
+        net.setPreferableBackend(cv.dnn.DNN_BACKEND_OPENCV)
+        net.setPreferableTarget(cv.dnn.DNN_TARGET_CPU)
 
     return net, nn_size
 
@@ -110,20 +175,61 @@ def main(args):
     #assert any(outopts)
     assert all(os.path.isdir(x) for x in outopts if x is not None)
 
+    tempdir, nframes = prepare_video(args)
+    devices = plan_devices(args, nframes)
+    power = measure_power(args, devices)
+    workunits = plan_workunits(args, nframes, power)
+
+    # Kick off the actual thread_main() which processes the video
+    if len(workunits) == 1:
+        worker_main(args, 0, workunits[0], devices[0])
+    else:
+        pool = multiprocessing.Pool(processes=len(workunits))
+        pool.map_async(functools.partial(dispatch_worker, args),
+                    enumerate(zip(workunits, devices)), chunksize=1)
+        pool.close()
+        pool.join()
+
+    join_archives(args, workunits)
+
+
+# With --archive, each work unit packs its saved frames into its own part
+# archive. Joins the parts into a single VIDEONAME.zip in each directory.
+def join_archives(args, workunits):
+    if not args.archive:
+        return
+
+    name_prefix, _ = os.path.splitext(os.path.basename(args.video))
+    for directory in [args.save_original, args.save_preprocessed]:
+        if directory:
+            path = os.path.join(directory, name_prefix + '.zip')
+            merge_archives(path, [f'{path}.{wu[0]}' for wu in workunits])
+
+
+def load_frame_list(listfiles):
+    frame_list = {}
+    for listfile in listfiles:
+        with open(listfile) as f:
+            for line in f:
+                line = line.rstrip()
+                base, _ = os.path.splitext(os.path.basename(line))
+                if 'negatives/' in line:
+                    frame_list[base] = 'negatives'
+                else:
+                    frame_list[base] = '.'
+    return frame_list
+
+
+# Resolve --frame-list and --afr for args.video and optionally copy the video to
+# the ramdisk. Returns the ramdisk TemporaryDirectory (or None), which must be
+# kept alive while the video is processed, and the number of frames.
+def prepare_video(args):
+    tempdir = None
+
     # If frame lists are provided, create a map from filename_framenumber to
     # the directory to save the output file to.
-    if args.frame_list is not None:
-        frame_list = {}
-        for listfile in args.frame_list:
-            with open(listfile) as f:
-                for line in f:
-                    line = line.rstrip()
-                    base, _ = os.path.splitext(os.path.basename(line))
-                    if 'negatives/' in line:
-                        frame_list[base] = 'negatives'
-                    else:
-                        frame_list[base] = '.'
-        args.frame_list = frame_list
+    if isinstance(args.frame_list, list):
+        args.frame_list = load_frame_list(args.frame_list)
     
     # sbatchelder 2022-06-01 adaptive frame rate
     if args.afr:
@@ -149,55 +255,494 @@ def main(args):
     nframes = int(video.get(cv.CAP_PROP_FRAME_COUNT))
     del video
 
+    return tempdir, nframes
+
+
+# Determine the device of each worker, as (backend, gpu) pairs. GPUs are shared
+# round-robin by at most --workers-per-gpu of the --num-cores workers, and
+# --cpu-workers CPU workers run alongside them.
+def plan_devices(args, nframes):
+    if args.backend == 'cpu':
+        devices = [('cpu', None)] * args.num_cores
+    else:
+        gpus = max(num_gpus(), 1)
+        ngpu_workers = min(args.num_cores, gpus * args.workers_per_gpu)
+        devices = [('cuda', i % gpus) for i in range(ngpu_workers)]
+        devices += [('cpu', None)] * args.cpu_workers
+
+    # Every work unit after the first re-processes --bg-history frames to prime
+    # the background subtractor. Drop workers (CPU workers first) if that would
+    # exceed --max-priming-overhead of the video.
+    if nframes is not None:
+        max_workunits = 1 + int(args.max_priming_overhead * nframes / args.bg_history)
+        devices = devices[:max(1, max_workunits)]
+    return devices
+
+
+# Relative speed of the worker on each device, used to size its work unit
+def measure_power(args, devices):
+    distinct = list(set(devices))
+    if args.calibrate_frames <= 0 or len(distinct) == 1:
+        return [1] * len(devices)
+
+    # Measure in pool processes, so that the parent never creates a CUDA
+    # context before forking the workers
+    with multiprocessing.Pool(processes=len(distinct)) as pool:
+        fps = pool.map(functools.partial(measure_throughput, args), distinct)
+    fps = dict(zip(distinct, fps))
+    for device in distinct:
+        print(f'{device[0]}{"" if device[1] is None else device[1]}: {fps[device]:.1f} frames/s')
+
+    # Workers sharing a device also share its throughput
+    return [fps[d] / devices.count(d) for d in devices]
+
+
+# Time the preprocessing of --calibrate-frames frames from the start of the
+# video on `device`, returning frames per second
+def measure_throughput(args, device):
+    args = use_device(args, device)
+    engine = create_engine(args)
+
+    video = cv.VideoCapture(args.video)
+    frames = []
+    for _ in range(args.calibrate_frames + 1):
+        success, frame = video.read()
+        if not success:
+            break
+        frames.append(frame)
+    if len(frames) < 2:
+        return 1.0
+
+    # The first frame warms up the engine and is not timed
+    prev = engine.gray(engine.upload(frames[0]))
+    start = time.perf_counter()
+    for frame in frames[1:]:
+        frame = engine.upload(frame)
+        mask = engine.foreground(frame)
+        gray = engine.gray(frame)
+        engine.composite(engine.flow(prev, gray), mask, gray)
+        prev = gray
+
+    return (len(frames) - 1) / (time.perf_counter() - start)
+
+
+# Split the video into work units of (first frame to process, first frame to
+# save, last frame) sized by each worker's power, each primed with
+# args.bg_history frames.
+def plan_workunits(args, nframes, power=None):
     # Break the frames into work units, scaled by compute power
-    power = [1] * args.num_cores
+    if power is None:
+        power = [1] * args.num_cores
     
+    # Every work unit should save at least as many frames as it primes. If the
+    # video is too short for that, drop the last workers (CPU workers first).
+    min_size = 2 * args.bg_history
+    while len(power) > 1 and nframes + (len(power)-1) * args.bg_history < len(power) * min_size:
+        power = power[:-1]
+
     # Total number of frames to process, including duplicates for priming the
     # foreground extraction model.
-    wutotframes = nframes + (args.num_cores-1) * args.bg_history
+    wutotframes = nframes + (len(power)-1) * args.bg_history
+
+    # Size the work units by power, but give slow workers at least min_size
+    # frames, shared out from the faster ones
+    fixed = [False] * len(power)
+    while True:
+        free = wutotframes - min_size * sum(fixed)
+        freepower = sum(p for p, f in zip(power, fixed) if not f)
+        sizes = [min_size if f else p/freepower * free for p, f in zip(power, fixed)]
+        if len(power) == 1 or all(size >= min_size for size in sizes):
+            break
+        fixed = [f or size < min_size for f, size in zip(fixed, sizes)]
 
     workunits, start = [], 0
-    for p in power:
-        wusize = round(p/sum(power) * wutotframes)
+    for size in sizes:
+        wusize = round(size)
         workunits.append((
             # first frame to process
             start,
             # first frame to save
             0 if start == 0 else start + args.bg_history,
             # last frame (excluded)
-            start + wusize,
+            min(start + wusize, nframes),
         ))
         start = start + wusize - args.bg_history
     workunits[-1] = (workunits[-1][0], workunits[-1][1], nframes)
 
-    # Kick off the actual thread_main() which processes the video
-    if args.num_cores == 1:
-        worker_main(args, 0, workunits[0])
-    else:
-        pool = multiprocessing.Pool(processes=args.num_cores)
-        pool.map_async(functools.partial(dispatch_worker, args),
-                    enumerate(workunits), chunksize=1)
-        pool.close()
-        pool.join()
+    for wu in workunits:
+        assert wu[0] <= wu[1] <= wu[2], f'Bad work unit {wu}'
+    return workunits
 
 
 # We can't use a lambda with map_async it seems, so just a dummy dispatch that
-# unwraps the (n, workunit) argument
+# unwraps the (n, (workunit, device)) argument
 def dispatch_worker(args, nwu):
-    worker_main(args, nwu[0], nwu[1])
+    worker_main(args, nwu[0], *nwu[1])
 
 
-def worker_main(args, n, workunit):
+def worker_main(args, n, workunit, device=None):
 
-    # Assign a GPU to us
-    try: assign_gpu(n)
-    except Exception as e:
-        print("ASSIGN_GPU(n):",type(e),e)
+    # Run on our device, by default the GPU matching our worker number
+    args = use_device(args, device or (args.backend, n))
 
 
     # Load the neural network
     net, nn_size = load_network(n, args)
 
+    process_workunit(args, n, workunit, net, nn_size)
+
+
+# Decodes the rows of all of the Darknet Region layer outputs at once. Each row
+# is (center x, center y, width, height, objectness, class scores...), relative
+# to the image size. Returns lists of [left, top, width, height] boxes in
+# absolute coordinates and the confidence of their best class, for the rows
+# whose confidence is at least `threshold`. Coordinates are truncated to ints
+# in the same order as the original per-row loop, so boxes are unchanged.
+def decode_darknet(nnouts, width, height, threshold):
+    rows = np.concatenate([nnout.reshape(-1, nnout.shape[-1]) for nnout in nnouts])
+
+    # Determine the classification with the highest confidence
+    confidences = rows[:, 5:].max(axis=1)
+    keep = confidences >= threshold
+    rows, confidences = rows[keep], confidences[keep]
+
+    # Convert the bounding boxes to absolute coordinates
+    center_x = (rows[:, 0] * width).astype(int)
+    center_y = (rows[:, 1] * height).astype(int)
+    boxwidth = (rows[:, 2] * width).astype(int)
+    boxheight = (rows[:, 3] * height).astype(int)
+    left = (center_x - boxwidth / 2).astype(int)
+    top = (center_y - boxheight / 2).astype(int)
+
+    boxes = np.stack([left, top, boxwidth, boxheight], axis=1)
+    return boxes.tolist(), confidences.tolist()
+
+
+# Resizes `image` to fit `size` without changing its aspect ratio and pads the
+# rest with gray, as yolov5 does. Returns the padded image, the scale factor and
+# the (x, y) padding.
+def letterbox(image, size):
+    height, width, _ = image.shape
+    r = min(size[0] / width, size[1] / height)
+    resized = (round(width * r), round(height * r))
+    padx, pady = (size[0] - resized[0]) / 2, (size[1] - resized[1]) / 2
+
+    if resized != (width, height):
+        image = cv.resize(image, resized, interpolation=cv.INTER_LINEAR)
+    top, bottom = round(pady - 0.1), round(pady + 0.1)
+    left, right = round(padx - 0.1), round(padx + 0.1)
+    image = cv.copyMakeBorder(image, top, bottom, left, right,
+                              cv.BORDER_CONSTANT, value=(114, 114, 114))
+    return image, r, (padx, pady)
+
+
+# Decodes the output of a yolov5 ONNX model for one letterboxed image. Each row
+# is (center x, center y, width, height, objectness, class scores...), in pixels
+# of the letterboxed image. Returns the same lists as decode_darknet, in the
+# coordinates of the original image.
+def decode_yolov5(pred, r, pad, threshold):
+    # yolov5 scores each class by objectness times class probability
+    confidences = pred[:, 4] * pred[:, 5:].max(axis=1)
+    keep = confidences >= threshold
+    pred, confidences = pred[keep], confidences[keep]
+
+    # Undo the letterbox
+    center_x = (pred[:, 0] - pad[0]) / r
+    center_y = (pred[:, 1] - pad[1]) / r
+    boxwidth = (pred[:, 2] / r).astype(int)
+    boxheight = (pred[:, 3] / r).astype(int)
+    left = (center_x - boxwidth / 2).astype(int)
+    top = (center_y - boxheight / 2).astype(int)
+
+    boxes = np.stack([left, top, boxwidth, boxheight], axis=1)
+    return boxes.tolist(), confidences.tolist()
+
+
+# Runs the network on a list of composite BGR images. Returns a (boxes,
+# confidences) pair for each image, before non-maximum suppression.
+def detect_batch(args, net, nn_size, outputs):
+    if args.nn_onnx:
+        # Feed in the letterboxed images as a single batch
+        letterboxed = [letterbox(output, nn_size) for output in outputs]
+        blob = cv.dnn.blobFromImages(
+            [image for image, _, _ in letterboxed],
+            1/255.0, nn_size, [0, 0, 0], True, crop=False
+        )
+        net.setInput(blob)
+        preds = net.forward()
+
+        return [decode_yolov5(pred, r, pad, args.nn_threshold)
+                for pred, (_, r, pad) in zip(preds, letterboxed)]
+
+    detections = []
+    for output in outputs:
+        # Create the blob to feed to the network
+        blob = cv.dnn.blobFromImage(
+            np.float32(output),
+            1/255.0, nn_size, [0, 0, 0], True, crop=False
+        )
+
+        # Feed in the blob and get out the detections
+        net.setInput(blob)
+        nnouts = net.forward(net.getUnconnectedOutLayersNames())
+
+        lastlayer = net.getLayer(net.getLayerId(net.getLayerNames()[-1]))
+        assert lastlayer.type == 'Region'
+
+        # Interpret the network output as classification and bounding box
+        height, width, _ = output.shape
+        detections.append(decode_darknet(nnouts, width, height, args.nn_threshold))
+    return detections
+
+
+# True if --motion-gate is set and the frame has less foreground than it
+def motion_gated(args, output):
+    return args.motion_gate is not None and foreground_fraction(output) < args.motion_gate
+
+
+# Generator over the frames of a work unit along with their detections. Frames
+# are passed to the network --nn-batch at a time for ONNX models. Frames closed
+# by --motion-gate are yielded straight away with no detections, possibly ahead
+# of frames still waiting in a batch. They are tallied in `counts`, if given.
+def detect_frames(args, net, nn_size, frames, counts=None):
+    batch_size = args.nn_batch if args.nn_onnx else 1
+    batch = []
+    for frame in frames:
+        if counts is not None:
+            counts['frames'] += 1
+        if motion_gated(args, frame[3]):
+            if counts is not None:
+                counts['gated'] += 1
+            yield frame, ([], [])
+            continue
+        batch.append(frame)
+        if len(batch) == batch_size:
+            yield from zip(batch, detect_batch(args, net, nn_size, [f[3] for f in batch]))
+            batch = []
+    if batch:
+        yield from zip(batch, detect_batch(args, net, nn_size, [f[3] for f in batch]))
+
+
+# Processes the frames of a work unit with an already loaded network. The
+# preprocessing engine is reused if one is given.
+def process_workunit(args, n, workunit, net, nn_size, engine=None):
+
+    # Only compute the preprocessed composite if something is going to use it
+    frames = preprocess_frames(args, n, workunit, engine=engine,
+                               preprocess=bool(net or args.save_preprocessed))
+
+    # Without a network, the frames only need to be saved
+    if not net:
+        for _ in frames:
+            pass
+        return
+
+    counts = collections.Counter()
+    for (nf, timestamp, out, output), (boxes, confidences) in \
+            detect_frames(args, net, nn_size, frames, counts):
+
+        # -- Neural network ---------------------------------------------------
+
+        # Apply non-maximum suppression to eliminate overlapping boxes
+        indices = \
+            cv.dnn.NMSBoxes(boxes, confidences, args.nn_threshold, args.nn_nms)
+        indices = np.array(indices, dtype=int).reshape(-1)  # Nx1 before OpenCV 4.5.4, N after
+
+        boxes = [ boxes[i] for i in indices ]
+        confidences = [ confidences[i] for i in indices ]
+
+        # Save detection data if desired
+        if boxes and args.save_detection_data:
+            detout = {
+                'video': args.video,
+                'frame': {
+                    'width': output.shape[1],
+                    'height': output.shape[0],
+                    'number': nf,
+                    'timestamp_msec': timestamp,
+                }
+            }
+            detections = detout['detections'] = []
+
+            for conf, box in zip(confidences, boxes):
+                detections.append({
+                    'left': box[0],
+                    'top': box[1],
+                    'width': box[2],
+                    'height': box[3],
+                    'confidence': conf,
+                })
+
+            path = os.path.join(args.save_detection_data, out + '_boxes.json')
+            with open(path, 'w') as f:
+                json.dump(detout, f)
+
+        # Draw labels on an image if desired
+        if args.save_detection_image:
+            labeled = output.copy()
+            for conf, box in zip(confidences, boxes):
+                left, top = box[0], box[1]
+                right, bot = box[0] + box[2], box[1] + box[3]
+
+                # Draw bounding box
+                cv.rectangle(
+                    labeled,
+                    (left, top),
+                    (right, bot),
+                    (0, 255, 0)
+                )
+
+                # Draw label background
+                label = '%.2f' % conf
+                labelsz, baseline = \
+                    cv.getTextSize(label, cv.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+                top = max(top, labelsz[1])
+                cv.rectangle(
+                    labeled,
+                    (left, top - labelsz[1]),
+                    (left + labelsz[0], top + baseline),
+                    (255, 255, 255),
+                    cv.FILLED
+                )
+
+                # Draw label
+                cv.putText(labeled, label, (left, top),
+                            cv.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0))
+
+            # Write out file
+            path = os.path.join(args.save_detection_image, out + '_labeled.jpg')
+            cv.imwrite(path, labeled)
+
+    if args.motion_gate is not None:
+        print(f'G{n:02}: --motion-gate skipped the network on {counts["gated"]} of {counts["frames"]} frames')
+
+
+# State of a --video-list pool process: its worker number, device, network and
+# preprocessing engine, created once and reused for every video it processes
+pool_worker = None
+
+
+def init_pool_worker(args, devices):
+    global pool_worker
+    n, device = devices.get()
+    args = use_device(args, device)
+    net, nn_size = load_network(n, args)
+    pool_worker = dict(n=n, backend=args.backend, net=net, nn_size=nn_size,
+                       engine=create_engine(args))
+
+
+def pool_worker_main(args, nframes):
+    w = pool_worker
+    args.backend = w['backend']
+    workunit = (0, 0, nframes)
+    process_workunit(args, w['n'], workunit, w['net'], w['nn_size'],
+                     engine=w['engine'])
+    join_archives(args, [workunit])
+
+
+def main_video_list(args):
+    with open(args.video_list) as f:
+        videos = [line.strip() for line in f if line.strip()]
+
+    # Validate our settings
+    outopts = [
+        args.save_detection_data,
+        args.save_detection_image,
+        args.save_original,
+        args.save_preprocessed,
+    ]
+    assert all(os.path.isdir(x) for x in outopts if x is not None)
+
+    # Frame lists are shared by all of the videos
+    if isinstance(args.frame_list, list):
+        args.frame_list = load_frame_list(args.frame_list)
+
+    # Videos are processed whole, one per worker, so there are no work units to
+    # prime. Each pool process takes one of the devices.
+    devices = plan_devices(args, None)
+    device_queue = multiprocessing.Queue()
+    for n, device in enumerate(devices):
+        device_queue.put((n, device))
+    pool = multiprocessing.Pool(processes=len(devices), initializer=init_pool_worker,
+                                initargs=(args, device_queue))
+
+    # Copy the next videos to the ramdisk while the current ones are processed
+    def stage(video):
+        vargs = copy.copy(args)
+        vargs.video = video
+        video_name, _ = os.path.splitext(os.path.basename(video))
+        for opt in ['save_original', 'save_preprocessed', 'save_detection_data', 'save_detection_image']:
+            # Archives are already one per video
+            if args.archive and opt in ['save_original', 'save_preprocessed']:
+                continue
+            if getattr(args, opt):
+                setattr(vargs, opt, os.path.join(getattr(args, opt), video_name))
+                os.makedirs(getattr(vargs, opt), exist_ok=True)
+        tempdir, nframes = prepare_video(vargs)
+        return vargs, tempdir, nframes
+
+    stager = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    pending = collections.deque(videos)
+    staged = collections.deque()
+    while pending and len(staged) <= len(devices):
+        video = pending.popleft()
+        staged.append((video, stager.submit(stage, video)))
+
+    # Workers report each finished (or failed) video here, so that the next
+    # video goes to whichever worker frees up first
+    finished = queue.Queue()
+    def on_finish(video, tempdir, error=None):
+        finished.put((video, tempdir, error))
+
+    # A video that fails is logged and skipped, the rest of the list still runs
+    running, failed = 0, []
+    while staged or running:
+        # Hand staged videos to any free workers
+        while staged and running < len(devices):
+            video, future = staged.popleft()
+            if pending:
+                next_video = pending.popleft()
+                staged.append((next_video, stager.submit(stage, next_video)))
+            try:
+                vargs, tempdir, nframes = future.result()
+            except Exception as e:
+                print('FAILED:', video, repr(e))
+                failed.append(video)
+                continue
+            pool.apply_async(pool_worker_main, (vargs, nframes),
+                             callback=lambda _, v=video, t=tempdir: on_finish(v, t),
+                             error_callback=lambda e, v=video, t=tempdir: on_finish(v, t, e))
+            running += 1
+        if not running:
+            continue
+
+        # Wait for any video to finish, and free its ramdisk copy
+        video, tempdir, error = finished.get()
+        running -= 1
+        if tempdir is not None:
+            tempdir.cleanup()
+        if error is not None:
+            print('FAILED:', video, repr(error))
+            failed.append(video)
+        else:
+            print('DONE:', video)
+
+    stager.shutdown()
+    pool.close()
+    pool.join()
+
+    if failed:
+        raise SystemExit(f'{len(failed)} of {len(videos)} videos failed: ' + ' '.join(failed))
+
+
+# Generator over the frames of a work unit. Queues --save-original and
+# --save-preprocessed images on a background writer, which is flushed once the
+# work unit is finished, and yields (frame number, timestamp in msec,
+# output name, composite BGR image) for every saved frame if `preprocess` is
+# set. Unless one is given to be reset and reused, the preprocessing engine is
+# created by whichever thread iterates the generator.
+def preprocess_frames(args, n, workunit, preprocess=True, engine=None):
+
     # Open the video file
     video = cv.VideoCapture(args.video)
     
@@ -216,28 +761,12 @@ def worker_main(args, n, workunit):
     video.set(cv.CAP_PROP_POS_FRAMES, workunit[0])
     assert int(video.get(cv.CAP_PROP_POS_FRAMES)) == workunit[0]
 
-    # Create the optical flow calculator
-    flowengine = cv.cuda_FarnebackOpticalFlow.create(
-        args.of_levels,
-        args.of_pyr_scale,
-        False,
-        args.of_winsize,
-        args.of_iterations,
-        args.of_poly_n,
-        args.of_poly_sigma,
-        0
-    )
-
-    # Create the background subtractor
-    bgsub = cv.cuda.createBackgroundSubtractorMOG2(
-        history=args.bg_history,
-        varThreshold=args.bg_var_threshold,
-        detectShadows=False
-    )
-
-    # Create the opening filter
-    kernel = cv.getStructuringElement(cv.MORPH_RECT, (7, 7))
-    filter = cv.cuda.createMorphologyFilter(cv.MORPH_OPEN, cv.CV_8UC4, kernel)
+    # Create the preprocessing engine (optical flow, background subtraction,
+    # and opening filter) for the selected backend
+    if engine is None:
+        engine = create_engine(args)
+    else:
+        engine.reset()
 
     prev = None
 
@@ -245,56 +774,63 @@ def worker_main(args, n, workunit):
     if args.progress:
         iterator = tqdm.tqdm(iterator, position=n, desc=f'G{n:02}')
 
-    # If --of-history is passed, we will use the flow from the previous frame
-    # to inform the flow in this frame.
-    last_flow = None
-
     # Compute the prefix of the video name, for building frame filenames later
     name_prefix, _ = os.path.splitext(os.path.basename(args.video))
 
-    stream = cv.cuda_Stream()
-
-    for nf in iterator:
-        # Read the next frame
-        success, frame = video.read()
-        assert success
+    # Determine whether we will want to save the image of frame number `fn`
+    def is_saved(fn):
+        # 2022-06-01 sbatchelder enabling Adaptive Frame Rate output
+        if args.afr:
+            return fn % args.afr == 0
+        return args.frame_list is None or \
+            '%s_%i' % (name_prefix, get_timestamp(fn)) in args.frame_list
 
-        # Upload the frame to the device
-        frame_local = frame[:]
-        frame = cv.cuda_GpuMat(frame.shape[0], frame.shape[1], cv.CV_8UC3)
-        frame.upload(frame_local, stream=stream)
+    # Number of grayscale and equalization conversions avoided by --lazy-pairs
+    skipped_ops = 0
 
-        # Resize the frame if necessary
-        if args.resize:
-            frame = cv.cuda.resize(frame, tuple(args.resize), stream=stream)
+    # Saved images are encoded and written on background threads. With
+    # --archive, they go into a part archive for this work unit.
+    archive = f'{name_prefix}.zip.{workunit[0]}' if args.archive else None
+    writer = create_writer(args, archive)
 
+    for nf in iterator:
         # Compute the output filename
         out = '%s_%i' % (name_prefix, get_timestamp(nf))
 
         # Determine whether we will want to save this image
-        save_this = args.frame_list is None or out in args.frame_list
-        
-        # 2022-06-01 sbatchelder enabling Adaptive Frame Rate output
-        if args.afr:
-            save_this = nf % args.afr == 0 
+        save_this = is_saved(nf)
 
         # Modify the out path to use whatever directory prefix we are sorting into.
         if args.frame_list is not None:
             out = os.path.join(args.frame_list.get(out,'.'), out)
 
+        # Without preprocessing, frames that will not be saved are never looked
+        # at. Advance past them with grab(), which skips retrieving and
+        # converting the frame.
+        if not (preprocess or save_this):
+            success = video.grab()
+            assert success
+            continue
+
+        # Read the next frame
+        success, frame = video.read()
+        assert success
+        frame_local = frame[:]
+
         if args.save_original and save_this:
-            path = os.path.join(args.save_original, out + '.jpg')  # _original.jpg
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-            cv.imwrite(path, frame_local)
+            writer.write(args.save_original, out, frame_local)  # _original.jpg
         
         # Zero'th exit early spot. Skip image preprocessing
-        if not (net or args.save_preprocessed):
+        if not preprocess:
             continue
+
+        # Upload the frame to the device, resizing if necessary
+        frame = engine.upload(frame_local)
             
         # -- Foreground extraction --------------------------------------------
 
         # Apply background subtraction to determine the mask
-        mask = bgsub.apply(frame, -1, stream=stream)
+        mask = engine.foreground(frame)
 
         # Store the result in the green channel
         green_channel = mask
@@ -305,11 +841,19 @@ def worker_main(args, n, workunit):
         if nf < workunit[1] - 1:
             continue
 
+        # With --lazy-pairs, the grayscale and equalized images are only made
+        # for the (previous, saved) frame pairs that optical flow is computed
+        # on. The background subtractor above still sees every frame.
+        if args.lazy_pairs and not (save_this or is_saved(nf + 1)):
+            prev = None
+            skipped_ops += 2 if args.of_equalize_luminance else 1
+            continue
+
 
         # -- Raw image --------------------------------------------------------
 
         # Convert the frame to grayscale and store it in the red channel
-        gray = cv.cuda.cvtColor(frame, cv.COLOR_BGR2GRAY, stream=stream)
+        gray = engine.gray(frame)
         red_channel = gray
 
 
@@ -317,15 +861,7 @@ def worker_main(args, n, workunit):
 
         # Equalize the luminance histogram of the image
         if args.of_equalize_luminance:
-            y, u, v = cv.cuda.split(cv.cuda.cvtColor(frame, cv.COLOR_BGR2YUV, stream=stream), stream=stream)
-            y = cv.cuda.equalizeHist(y, stream=stream)
-
-            eqframe = cv.cuda_GpuMat(y.size(), cv.CV_8UC3)
-            cv.cuda.merge((y, u, v), eqframe, stream=stream)
-            eqframe = cv.cuda.cvtColor(eqframe, cv.COLOR_YUV2RGB,
-                                       stream=stream)  # no direct YUV2GRAY
-            eqframe = cv.cuda.cvtColor(eqframe, cv.COLOR_RGB2GRAY,
-                                       stream=stream)
+            eqframe = engine.equalized_gray(frame)
         else:
             eqframe = gray
 
@@ -344,169 +880,32 @@ def worker_main(args, n, workunit):
         # may want to clear history between non-consecutive frames.
 
 
-        # Compute optical flow between current frame and previous
-        flow = flowengine.calc(preveqframe, eqframe, last_flow, stream=stream)
-        if args.of_history:
-            last_flow = flow
-
-        # Visualize the flow in color
-        x, y = cv.cuda.split(flow, stream=stream)
-        mag, ang = cv.cuda.cartToPolar(x, y, stream=stream)
-
-        c = cv.cuda_GpuMat(frame.size(), cv.CV_32FC1, 255 / (2*np.pi))
-        hue = cv.cuda.multiply(c, ang, stream=stream)
-        sat = cv.cuda_GpuMat(frame.size(), cv.CV_32FC1, 255)
-        val = cv.cuda.normalize(mag, 0, 255, cv.NORM_MINMAX, -1, stream=stream)
-
-        hsv = cv.cuda_GpuMat(frame.size(), cv.CV_32FC3)
-        cv.cuda.merge((hue, sat, val), hsv, stream=stream)
-
-        # Convert to BGRA
-        bgr = cv.cuda.cvtColor(hsv, cv.COLOR_HSV2BGR, stream=stream)
-        bgra = cv.cuda.cvtColor(bgr, cv.COLOR_BGR2BGRA, stream=stream)
-
-        # Apply an opening operator
-        x = cv.cuda_GpuMat(frame.size(), cv.CV_8UC4)
-        bgra.convertTo(cv.CV_8UC4, x)
-        bgra = filter.apply(x)
-
-        # Store the result in the blue channel
-        bgrgray = cv.cuda.cvtColor(bgra, cv.COLOR_BGRA2GRAY, stream=stream)
-        blue_channel = bgrgray
+        # Compute optical flow between current frame and previous, visualize
+        # it, apply an opening operator, and store the result in the blue
+        # channel
+        blue_channel = engine.flow(preveqframe, eqframe)
 
 
         # ---------------------------------------------------------------------
 
-        # Combine the channels
-        combined = cv.cuda_GpuMat(blue_channel.size(), cv.CV_8UC3)
-        cv.cuda.merge((
+        # Combine the channels and retrieve the finished image from the device
+        output = engine.composite(
             blue_channel,
             green_channel,
             red_channel,
-        ), combined, stream=stream)
-
-        # Download the combined image from the device
-        output = combined.download(stream=stream)
-
-        # Wait for completion of the stream, after which point the finished
-        # image should be in the `output` array.
-        stream.waitForCompletion()
-
-        if args.save_preprocessed:
-            path = os.path.join(args.save_preprocessed, out + '.jpg')
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-            cv.imwrite(path, output)
-
-
-        # -- Neural network ---------------------------------------------------
-
-        if not net:
-            continue
-
-        # Create the blob to feed to the network
-        blob = cv.dnn.blobFromImage(
-            np.float32(output),
-            1/255.0, nn_size, [0, 0, 0], True, crop=False
         )
 
-        # Feed in the blob and get out the detections
-        net.setInput(blob)
-        nnouts = net.forward(net.getUnconnectedOutLayersNames())
-
-        lastlayer = net.getLayer(net.getLayerId(net.getLayerNames()[-1]))
-        assert lastlayer.type == 'Region'
-
-        # Interpret the network output as classification and bounding box
-        confidences, boxes = [], []
-        for nnout in nnouts:
-            for detection in nnout:
-                # Determine the classification with the highest confidence
-                scores = detection[5:]
-                classId = np.argmax(scores)
-                confidence = scores[classId].item()
-                if confidence < args.nn_threshold:
-                    continue
-                confidences.append(confidence)
-
-                # Convert the bounding box to absolute coordinates
-                height, width, _ = output.shape
-                center_x = int(detection[0] * width)
-                center_y = int(detection[1] * height)
-                boxwidth = int(detection[2] * width)
-                boxheight = int(detection[3] * height)
-                left = int(center_x - boxwidth / 2)
-                top = int(center_y - boxheight / 2)
-                boxes.append([left, top, boxwidth, boxheight])
-
-        # Apply non-maximum suppression to eliminate overlapping boxes
-        indices = \
-            cv.dnn.NMSBoxes(boxes, confidences, args.nn_threshold, args.nn_nms)
-        indices = indices[:,0] if len(indices) else []
-
-        boxes = [ boxes[i] for i in indices ]
-        confidences = [ confidences[i] for i in indices ]
-
-        # Save detection data if desired
-        if boxes and args.save_detection_data:
-            detout = {
-                'video': args.video,
-                'frame': {
-                    'width': output.shape[1],
-                    'height': output.shape[0],
-                    'number': nf,
-                    'timestamp_msec': get_timestamp(nf),
-                }
-            }
-            detections = detout['detections'] = []
-
-            for conf, box in zip(confidences, boxes):
-                detections.append({
-                    'left': box[0],
-                    'top': box[1],
-                    'width': box[2],
-                    'height': box[3],
-                    'confidence': conf,
-                })
-
-            path = os.path.join(args.save_detection_data, out + '_boxes.json')
-            with open(path, 'w') as f:
-                json.dump(detout, f)
+        if args.save_preprocessed:
+            writer.write(args.save_preprocessed, out, output)
 
-        # Draw labels on an image if desired
-        if args.save_detection_image:
-            labeled = output.copy()
-            for conf, box in zip(confidences, boxes):
-                left, top = box[0], box[1]
-                right, bot = box[0] + box[2], box[1] + box[3]
 
-                # Draw bounding box
-                cv.rectangle(
-                    labeled,
-                    (left, top),
-                    (right, bot),
-                    (0, 255, 0)
-                )
-
-                # Draw label background
-                label = '%.2f' % conf
-                labelsz, baseline = \
-                    cv.getTextSize(label, cv.FONT_HERSHEY_SIMPLEX, 0.5, 1)
-                top = max(top, labelsz[1])
-                cv.rectangle(
-                    labeled,
-                    (left, top - labelsz[1]),
-                    (left + labelsz[0], top + baseline),
-                    (255, 255, 255),
-                    cv.FILLED
-                )
+        yield nf, get_timestamp(nf), out, output
 
-                # Draw label
-                cv.putText(labeled, label, (left, top),
-                            cv.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0))
+    # Wait for the remaining images to be written
+    writer.close()
 
-            # Write out file
-            path = os.path.join(args.save_detection_image, out + '_labeled.jpg')
-            cv.imwrite(path, labeled)
+    if args.lazy_pairs:
+        print(f'G{n:02}: --lazy-pairs skipped {skipped_ops} grayscale/equalization ops')
 
 
 if __name__ == '__main__':
@@ -514,4 +913,9 @@ if __name__ == '__main__':
     args = parser.parse_args()
     if args.afr and args.frame_list: 
         parser.error('Error: --afr and --frame-list are mutually exclusive')
-    main(args)
+    if args.nn_onnx and args.nn_weights:
+        parser.error('Error: --nn-onnx and --nn-weights are mutually exclusive')
+    if args.video_list:
+        main_video_list(args)
+    else:
+        main(args)
@@ -2,9 +2,16 @@
 
 # built in imports
 import os, sys
+import hashlib
+import io
 import random
+import zipfile
+from multiprocessing.pool import ThreadPool
 
 # 3rd party imports
+import numpy as np
+import torch
+from PIL import Image
 from torchvision import transforms, datasets
 from torch.utils.data.dataset import Dataset, IterableDataset
 from torch import tensor
@@ -21,6 +28,22 @@ cat2count = {1:(-1,0,'A'),
              3:(5,10,'C'),
              4:(11,20,'D'),
              5:(21,40,'E')}
+def load_image(fp, draft_size=None):
+    """Loads an RGB image like datasets.folder.default_loader. With draft_size, JPEGs are
+    decoded by libjpeg at a reduced scale (1/2, 1/4 or 1/8) that is still at least
+    draft_size on each side, which is much faster than decoding at full resolution
+    only to resize it afterwards. fp may be a path or a file object"""
+    with Image.open(fp) as img:
+        if draft_size:
+            img.draft('RGB', (draft_size, draft_size))
+        return img.convert('RGB')
+
+
+def count_label_lines(label_file):
+    with open(label_file) as f:
+        return len(f.readlines())
+
+
 def count2cat(x):
     if x<=cat2count[1][1]: return cat2count[1][2]
     elif x<=cat2count[2][1]: return cat2count[2][2]
@@ -41,16 +64,24 @@ class HerringrunnerDataset(Dataset):
     adapted from: https://gist.github.com/andrewjong/6b02ff237533b3b2c554701fb53d5c4d
     """
 
-    def __init__(self, image_paths, resize=244, mode=['count','cat'][1]):
+    def __init__(self, image_paths, resize=244, mode=['count','cat'][1], manifest=None, img_cache=None, draft=False):
         images = [img for img in image_paths if img.endswith(datasets.folder.IMG_EXTENSIONS)]
         labels = [os.path.splitext(img)[0].replace('/images/','/labels/')+'.txt' for img in images]
         both = [(i,l) for i,l in zip(images,labels) if os.path.isfile(i) and os.path.isfile(l)]
         self.image_paths,self.label_paths = zip(*both)
-        self.image_counts = []
-        for label_file in self.label_paths:
-            with open(label_file) as f:
-                count = len(f.readlines())
-                self.image_counts.append(count)
+
+        # label counts are taken from a label manifest npz (see label_manifest.py) when given,
+        # by frame id. labels not in the manifest are read
+        manifest_counts = {}
+        if manifest:
+            with np.load(manifest) as m:
+                manifest_counts = dict(zip(m['frame'].tolist(), m['count'].tolist()))
+        frame_ids = [os.path.splitext(os.path.basename(l))[0] for l in self.label_paths]
+        unlisted = [l for l,f in zip(self.label_paths,frame_ids) if f not in manifest_counts]
+        with ThreadPool(16) as pool:
+            read_counts = dict(zip(unlisted, pool.map(count_label_lines, unlisted, chunksize=64)))
+        self.image_counts = [manifest_counts[f] if f in manifest_counts else read_counts[l]
+                             for l,f in zip(self.label_paths,frame_ids)]
         self.image_cat_labels = [count2cat(c) for c in self.image_counts]
         self.image_cats = [cats.index(c) for c in self.image_cat_labels]
         self.classes = cats
@@ -66,11 +97,51 @@ class HerringrunnerDataset(Dataset):
         if len(self.image_paths) == 0:
             raise RuntimeError('No images Loaded!!')
 
+        # decoded-image cache: images are decoded and resized once, on first use, into a
+        # uint8 memmap in img_cache (eg /dev/shm for RAM) shared by all loader workers and
+        # by later runs on the same image list, size and draft mode. it is opened lazily in each worker
+        self.resize = resize
+        self.draft_size = resize if draft else None
+        self.cache_paths = None
+        if img_cache:
+            key_parts = self.image_paths+(str(resize),)+(('draft',) if draft else ())
+            key = hashlib.sha1('\n'.join(key_parts).encode()).hexdigest()[:16]
+            base = os.path.join(img_cache, 'herringrunner-{}-{}'.format(key,resize))
+            self.cache_paths = base+'.u8', base+'.done'
+            if not all(os.path.isfile(p) for p in self.cache_paths):
+                os.makedirs(img_cache, exist_ok=True)
+                shape = (len(self.image_paths), resize, resize, 3)
+                np.memmap(self.cache_paths[0], dtype=np.uint8, mode='w+', shape=shape).flush()
+                np.memmap(self.cache_paths[1], dtype=np.uint8, mode='w+', shape=shape[:1]).flush()
+        self.cache = None
+
+    def __getstate__(self):
+        # loader workers open their own memmaps
+        state = self.__dict__.copy()
+        state['cache'] = None
+        return state
+
+    def load_cached(self, index):
+        if self.cache is None:
+            shape = (len(self.image_paths), self.resize, self.resize, 3)
+            self.cache = (np.memmap(self.cache_paths[0], dtype=np.uint8, mode='r+', shape=shape),
+                          np.memmap(self.cache_paths[1], dtype=np.uint8, mode='r+', shape=shape[:1]))
+        images, done = self.cache
+        if not done[index]:
+            image = load_image(self.image_paths[index], self.draft_size)
+            images[index] = np.asarray(self.transform.transforms[0](image))  # Resize
+            done[index] = 1
+        # same as transforms.ToTensor() of the resized image
+        return torch.from_numpy(np.array(images[index])).permute(2,0,1).float().div(255)
+
     def __getitem__(self, index):
         path = self.image_paths[index]
-        image = datasets.folder.default_loader(path)
-        if self.transform is not None:
-            image = self.transform(image)
+        if self.cache_paths:
+            image = self.load_cached(index)
+        else:
+            image = load_image(path, self.draft_size)
+            if self.transform is not None:
+                image = self.transform(image)
         target = self.targets[index]
         return image, tensor([target]), path
 
@@ -92,6 +163,22 @@ class HerringrunnerDataset(Dataset):
         return cpc
 
 
+def split_archive_path(path):
+    """Splits a frame archive member path like "VIDEONAME.zip/VIDEONAME_1234.jpg"
+    (see process_video.py --archive) into its archive and member name.
+    Returns (None, path) for regular files."""
+    archive, sep, member = path.partition('.zip'+os.sep)
+    if sep:
+        return archive+'.zip', member
+    return None, path
+
+
+def list_archive(archive_path):
+    """Returns the member paths of the images in a frame archive"""
+    with zipfile.ZipFile(archive_path) as zf:
+        return [os.path.join(archive_path, name) for name in zf.namelist() if name.endswith(datasets.folder.IMG_EXTENSIONS)]
+
+
 class HerringRUNnerDataset(Dataset):
     """
     Custom dataset that includes image file paths. Extends torchvision.datasets.ImageFolder
@@ -101,9 +188,14 @@ class HerringRUNnerDataset(Dataset):
     adapted from: https://gist.github.com/andrewjong/6b02ff237533b3b2c554701fb53d5c4d
     """
 
-    def __init__(self, image_paths, resize=244, input_src=None):
+    def __init__(self, image_paths, resize=244, input_src=None, draft=False):
         self.input_src = input_src
-        self.image_paths = [img for img in image_paths if img.endswith(datasets.folder.IMG_EXTENSIONS) and os.path.isfile(img)]
+        self.draft_size = resize if draft else None
+        self.archive_members = {}
+        self.image_paths = [img for img in image_paths if img.endswith(datasets.folder.IMG_EXTENSIONS) and self._exists(img)]
+
+        # frame archives are opened lazily, so that each loader worker gets its own file handle
+        self.archives = {}
 
         # use 299x299 for inception_v3, all other models use 244x244
         self.transform = transforms.Compose([transforms.Resize([resize, resize]),
@@ -114,9 +206,29 @@ class HerringRUNnerDataset(Dataset):
         if len(self.image_paths) == 0:
             raise RuntimeError('No images Loaded!!')
 
+    def _exists(self, path):
+        archive_path, member = split_archive_path(path)
+        if archive_path is None:
+            return os.path.isfile(path)
+        if archive_path not in self.archive_members:
+            members = set()
+            if os.path.isfile(archive_path):
+                with zipfile.ZipFile(archive_path) as zf:
+                    members = set(zf.namelist())
+            self.archive_members[archive_path] = members
+        return member in self.archive_members[archive_path]
+
+    def load(self, path):
+        archive_path, member = split_archive_path(path)
+        if archive_path is None:
+            return load_image(path, self.draft_size)
+        if archive_path not in self.archives:
+            self.archives[archive_path] = zipfile.ZipFile(archive_path)
+        return load_image(io.BytesIO(self.archives[archive_path].read(member)), self.draft_size)
+
     def __getitem__(self, index):
         path = self.image_paths[index]
-        image = datasets.folder.default_loader(path)
+        image = self.load(path)
         if self.transform is not None:
             image = self.transform(image)
         return image, path
@@ -138,8 +250,11 @@ def get_trainval_datasets(args):
         
     mode = 'count' if args.counts_mode else 'cat'
     
-    training_dataset = HerringrunnerDataset(training_list, resize, mode)
-    validation_dataset = HerringrunnerDataset(validation_list, resize, mode)
+    manifest = getattr(args, 'label_manifest', None)
+    img_cache = getattr(args, 'img_cache', None)
+    draft = getattr(args, 'draft', False)
+    training_dataset = HerringrunnerDataset(training_list, resize, mode, manifest, img_cache, draft)
+    validation_dataset = HerringrunnerDataset(validation_list, resize, mode, manifest, img_cache, draft)
 
     return training_dataset, validation_dataset
 
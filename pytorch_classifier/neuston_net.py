@@ -19,7 +19,7 @@ from torchvision.datasets.folder import IMG_EXTENSIONS
 import ifcb
 from neuston_models import MetaModel
 from neuston_callbacks import SaveValidationResults, SaveTestResults
-from neuston_data import get_trainval_datasets, HerringrunnerDataset, HerringRUNnerDataset
+from neuston_data import get_trainval_datasets, HerringrunnerDataset, HerringRUNnerDataset, list_archive
 
 ## NOTES ##
 # https://pytorch-lightning.readthedocs.io/en/0.8.5/introduction_guide.html
@@ -213,6 +213,8 @@ def do_run(args):
             img_paths = f.readlines()
             img_paths = [img.strip() for img in img_paths]
             img_paths = [img for img in img_paths if img.endswith(IMG_EXTENSIONS)]
+    elif os.path.isfile(args.SRC) and args.SRC.endswith('.zip'): # frame archive from process_video.py --archive
+        img_paths = list_archive(args.SRC)
     elif args.SRC.endswith(IMG_EXTENSIONS): # single img # TODO TEST: single img run
         img_paths.append(args.SRC)
 
@@ -231,7 +233,7 @@ def do_run(args):
     else:
         resize_val = classifier.hparams.resize
 
-    image_dataset = HerringRUNnerDataset(img_paths, resize=resize_val, input_src=args.SRC)
+    image_dataset = HerringRUNnerDataset(img_paths, resize=resize_val, input_src=args.SRC, draft=args.draft)
     image_loader = DataLoader(image_dataset, batch_size=args.batch_size,
                               pin_memory=True, num_workers=args.loaders)
 
@@ -253,6 +255,7 @@ def argparse_nn(parser=None):
     common = parser.add_argument_group(title='NN Common Args', description=None)
     common.add_argument('--batch', dest='batch_size', metavar='SIZE', default=108, type=int, help='Number of images per batch. Defaults is 108') # todo: auto-mode built in to ptl
     common.add_argument('--loaders', metavar='N', default=4, type=int, help='Number of data-loading threads. 4 per GPU is typical. Default is 4') # todo: auto-mode?
+    common.add_argument('--draft', action='store_true', help='Decode JPEGs at a reduced scale, close to the model input size, before resizing. Much faster for large frames')
 
     argparse_nn_train(train)
     argparse_nn_run(run)
@@ -277,6 +280,8 @@ def argparse_nn_train(train_subparser):
 
     data = train_subparser.add_argument_group(title='Dataset Adjustments', description=None)
     data.add_argument('--seed', default=0, type=int, help='Set a specific seed for deterministic output & dataset-splitting reproducability.')
+    data.add_argument('--img-cache', metavar='DIR', help='Decode and resize each image once into a uint8 memmap cache in DIR, read by later epochs. Use /dev/shm to keep it in RAM')
+    data.add_argument('--label-manifest', metavar='NPZ', help='Label manifest from generate_training_lists.py (eg SRC/.label_manifest.npz). Label counts are read from it instead of from each label file')
     #TODO data.add_argument('--categories', help='list of values are used to demarcate different categories, less-than-or-equal-to. eg 0 5 10 15 20')
 
     epochs = train_subparser.add_argument_group(title='Epoch Parameters', description=None)
@@ -310,7 +315,7 @@ def argparse_nn_train(train_subparser):
 
 def argparse_nn_run(run_subparser):
     ## Run Vars ##
-    run_subparser.add_argument('SRC', help='Resource(s) to be classified. Accepts an image, a text-file, or a directory. Directories are accessed recursively')
+    run_subparser.add_argument('SRC', help='Resource(s) to be classified. Accepts an image, a text-file, a frame archive (.zip), or a directory. Directories are accessed recursively')
     run_subparser.add_argument('MODEL', help='Path to a previously-trained model file')
     run_subparser.add_argument('RUN_ID', help='Run ID. Used by --outdir')
 
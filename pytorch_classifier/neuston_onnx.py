@@ -1,23 +1,29 @@
 import io
 import os
+import json
+import time
+import datetime as dt
 
 import numpy as np
 import argparse
 
 import torch.onnx
+from torch.utils.data import DataLoader
 from pytorch_lightning import seed_everything
-from neuston_models import NeustonModel
-from neuston_data import ImageDataset
+from neuston_models import MetaModel
+from neuston_data import HerringrunnerDataset, HerringRUNnerDataset, list_archive
+from neuston_callbacks import save_run_results
 from scipy.special import softmax
 from PIL import Image
 
 IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
+GRAPH_OPT_LEVELS = dict(disable='ORT_DISABLE_ALL', basic='ORT_ENABLE_BASIC', extended='ORT_ENABLE_EXTENDED', all='ORT_ENABLE_ALL')
 
 
 def do_export(args):
 
     # load model
-    classifier = NeustonModel.load_from_checkpoint(args.MODEL)
+    classifier = MetaModel.load_from_checkpoint(args.MODEL)
     classes = classifier.hparams.classes
     seed_everything(classifier.hparams.seed)
     classifier.eval()
@@ -59,47 +65,203 @@ def do_export(args):
         f.write('\n'.join(classes))
     print('EXPORTED:', output_classes)
 
+    if args.quantize:
+        output_int8 = output.replace('.onnx','.INT8.onnx')
+        quantize(args, output, output_int8, resize=dummy_input.shape[-1], seed=classifier.hparams.seed)
+        print('EXPORTED:', output_int8)
+        with open(output_int8.replace('.onnx','.classes'),'w') as f:
+            f.write('\n'.join(classes))
+        print('EXPORTED:', output_int8.replace('.onnx','.classes'))
 
-def do_run(args):
-    import onnxruntime as ort
 
-    # inputs to array
+def quantize(args, model_fp32, model_int8, resize, seed=None):
+    """Quantizes the FP32 onnx model to INT8 with onnxruntime.
+    "dynamic" quantizes the weights ahead of time and the activations on the fly at inference.
+    "static" also fixes the activation ranges ahead of time, from the activations seen on a
+    sample of --calibration images, which is what makes convolutions run faster on CPU."""
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+    if args.quantize == 'dynamic':
+        quantize_dynamic(model_fp32, model_int8, weight_type=QuantType.QInt8)
+        return
+
+    img_paths = list_images(args.calibration)
+    if len(img_paths) > args.calibration_size:
+        img_paths = list(np.random.default_rng(seed).choice(img_paths, args.calibration_size, replace=False))
+    print('Calibrating on {} images'.format(len(img_paths)))
+    calibration_dataset = HerringRUNnerDataset(img_paths, resize=resize, input_src=args.calibration)
+    calibration_loader = DataLoader(calibration_dataset, batch_size=args.batch_size, num_workers=args.loaders)
+
+    class CalibrationReader(CalibrationDataReader):
+        def __init__(self):
+            self.batches = iter(calibration_loader)
+        def get_next(self):
+            batch = next(self.batches, None)
+            return None if batch is None else {'input': batch[0].numpy()}
+
+    quantize_static(model_fp32, model_int8, CalibrationReader(), quant_format=QuantFormat.QDQ,
+                    per_channel=True, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+
+
+def do_compare(args):
+    """Runs an FP32 model and its quantized counterpart side by side on a labelled, held-out
+    image list and reports the accuracy of each, their agreement, and their latency."""
+    sessions = [create_session(model, args) for model in (args.MODEL, args.QUANTIZED)]
+    resize = input_spec(sessions[0])[0]
+    dtypes = [input_spec(session)[1] for session in sessions]
+    model_classes = [read_classes(model) for model in (args.MODEL, args.QUANTIZED)]
+
+    # labels are read from the yolo label files alongside the images, as in training
+    dataset = HerringrunnerDataset(list_images(args.SRC), resize=resize, mode='cat', draft=args.draft)
+    loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.loaders)
+
+    true_labels, predictions, seconds, max_score_diff = [], [[],[]], [0.0,0.0], 0.0
+    for n, (batch, targets, paths) in enumerate(loader):
+        batch = batch.numpy()
+        scores = []
+        for i, session in enumerate(sessions):
+            if n == 0:  # warm-up, not timed
+                session.run(None, {'input':batch.astype(dtypes[i])})
+            start = time.perf_counter()
+            outputs = session.run(None, {'input':batch.astype(dtypes[i])})
+            seconds[i] += time.perf_counter() - start
+            out = softmax(np.asarray(outputs[0], dtype=np.float32), axis=1)
+            classes = model_classes[i] or dataset.classes
+            predictions[i].extend(classes[idx] for idx in np.argmax(out, axis=1))
+            scores.append(out)
+        true_labels.extend(dataset.classes[t] for t in targets.flatten().tolist())
+        max_score_diff = max(max_score_diff, float(np.abs(scores[0]-scores[1]).max()))
+
+    true_labels = np.array(true_labels)
+    predictions = [np.array(p) for p in predictions]
+    n_images = len(true_labels)
+    report = dict(images=n_images, batch_size=args.batch_size,
+                  agreement=float(np.mean(predictions[0]==predictions[1])),
+                  max_score_diff=max_score_diff,
+                  speedup=seconds[0]/seconds[1])
+    for name, model, pred, secs in zip(('fp32','quantized'), (args.MODEL,args.QUANTIZED), predictions, seconds):
+        report[name] = dict(model=model,
+                            size_mb=os.path.getsize(model)/2**20,
+                            accuracy=float(np.mean(pred==true_labels)),
+                            class_recall={c: float(np.mean(pred[true_labels==c]==c)) for c in dataset.classes if np.any(true_labels==c)},
+                            ms_per_image=1000*secs/n_images,
+                            images_per_second=n_images/secs)
+
+    print('{} images, batch size {}'.format(n_images, args.batch_size))
+    for name in ('fp32','quantized'):
+        r = report[name]
+        print('{:>9}: accuracy {:.4f}  {:.2f} ms/image  {:.1f} images/s  {:.1f} MB  {}'.format(
+              name, r['accuracy'], r['ms_per_image'], r['images_per_second'], r['size_mb'], r['model']))
+        print('{:>9}  recall {}'.format('', '  '.join('{}:{:.3f}'.format(c,v) for c,v in r['class_recall'].items())))
+    print('agreement {:.4f}  max score difference {:.4f}  speedup {:.2f}x'.format(
+          report['agreement'], report['max_score_diff'], report['speedup']))
+
+    if args.outfile:
+        os.makedirs(os.path.dirname(args.outfile) or '.', exist_ok=True)
+        with open(args.outfile, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Writing:', args.outfile)
+
+
+def list_images(src):
     img_paths = []
-    if os.path.isdir(args.SRC):
-        for pardir, _, imgs in os.walk(args.SRC):
+    if os.path.isdir(src):
+        for pardir, _, imgs in os.walk(src):
             imgs = [os.path.join(pardir, img) for img in imgs if img.endswith(IMG_EXTENSIONS)]
             img_paths.extend(imgs)
-    elif os.path.isfile(args.SRC) and args.SRC.endswith(('.txt','.list')):  # TODO TEST: textfile img run
-        with open(args.SRC, 'r') as f:
+    elif os.path.isfile(src) and src.endswith(('.txt','.list')):  # TODO TEST: textfile img run
+        with open(src, 'r') as f:
             img_paths = f.readlines()
             img_paths = [img.strip() for img in img_paths]
             img_paths = [img for img in img_paths if img.endswith(IMG_EXTENSIONS)]
-    elif args.SRC.endswith(IMG_EXTENSIONS):  # single img # TODO TEST: single img run
-        img_paths.append(args.SRC)
-    image_dataset = ImageDataset(img_paths, resize=299, input_src=args.SRC)
-    input_images = [path for _,path in image_dataset]
-    input_array = np.asarray([img.numpy() for img,_ in image_dataset])
-    #print(image_dataset)
-
-    # do inference
-    ort_session = ort.InferenceSession(args.MODEL)
-    outputs = ort_session.run(None, {'input':input_array})
-    out = np.asarray(outputs[0])
-    out = softmax(out,axis=1)
-    output_classes = np.argmax(out,axis=1)
-    output_scores = np.max(out,axis=1)
-
-    print(output_scores)
-    print(output_classes)
+    elif os.path.isfile(src) and src.endswith('.zip'):  # frame archive from process_video.py --archive
+        img_paths = list_archive(src)
+    elif src.endswith(IMG_EXTENSIONS):  # single img # TODO TEST: single img run
+        img_paths.append(src)
+    return img_paths
+
+
+def create_session(model_file, args):
+    import onnxruntime as ort
+    sess_options = ort.SessionOptions()
+    sess_options.intra_op_num_threads = args.intra_threads
+    sess_options.inter_op_num_threads = args.inter_threads
+    sess_options.graph_optimization_level = getattr(ort.GraphOptimizationLevel, GRAPH_OPT_LEVELS[args.graph_opt])
+    return ort.InferenceSession(model_file, sess_options, providers=['CPUExecutionProvider'])
+
+
+def input_spec(ort_session):
+    # input size is fixed by the exported model, 299 for inception_v3 and 224 otherwise
+    model_input = ort_session.get_inputs()[0]
+    resize = model_input.shape[-1] if isinstance(model_input.shape[-1], int) else 299
+    input_dtype = np.float16 if model_input.type == 'tensor(float16)' else np.float32
+    return resize, input_dtype
+
+
+def read_classes(model_file, classfile=None):
+    classfile = classfile or model_file.replace('.onnx','.classes')
+    if not os.path.isfile(classfile):
+        return None
+    with open(classfile) as f:
+        return [c.rstrip('\n') for c in f.readlines()]
+
+
+def do_run(args):
+
+    # inputs to array
+    img_paths = list_images(args.SRC)
+
+    ort_session = create_session(args.MODEL, args)
+    resize, input_dtype = input_spec(ort_session)
+
+    # images are decoded and batched by loader workers, so only a few batches are in memory at a time
+    image_dataset = HerringRUNnerDataset(img_paths, resize=resize, input_src=args.SRC, draft=args.draft)
+    image_loader = DataLoader(image_dataset, batch_size=args.batch_size, num_workers=args.loaders)
 
     # get labels
-    classfile = args.classfile or args.MODEL.replace('.onnx','.classes')
-    print(classfile)
-    if os.path.isfile(classfile):
-        with open(classfile) as f:
-            classes = [c.rstrip('\n') for c in f.readlines()]
-        output_labels = [classes[idx] for idx in output_classes]
-        print(output_labels)
+    classes = read_classes(args.MODEL, args.classfile)
+
+    model_id = os.path.splitext(os.path.basename(args.MODEL))[0]
+    timestamp = dt.datetime.now(dt.timezone.utc).isoformat(timespec='seconds')
+    outfiles = [os.path.join(args.outdir, outfile) for outfile in args.outfile or []]
+
+    # plain csv outputs are written as each batch completes. other formats are written by
+    # save_run_results at the end, from the per-image scores collected along the way
+    streamed = [outfile for outfile in outfiles if outfile.endswith('.csv') and 'COUNT' not in outfile and '{' not in outfile]
+    stream_files = []
+    for outfile in streamed:
+        os.makedirs(os.path.dirname(outfile) or '.', exist_ok=True)
+        f = open(outfile, 'w')
+        f.write(','.join(['frame',f'{model_id}__cat'])+'\n')
+        stream_files.append(f)
+
+    input_images, output_scores = [], []
+    for batch, paths in image_loader:
+        outputs = ort_session.run(None, {'input':batch.numpy().astype(input_dtype)})
+        out = softmax(np.asarray(outputs[0]),axis=1)
+        output_classes = np.argmax(out,axis=1)
+        output_labels = [classes[idx] if classes else str(idx) for idx in output_classes]
+        input_images.extend(paths)
+        output_scores.append(out.astype(np.float32))
+
+        frames = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+        for f in stream_files:
+            f.writelines('{},{}\n'.format(frame,label) for frame,label in zip(frames,output_labels))
+        if not outfiles:
+            for path,label,score in zip(paths,output_labels,np.max(out,axis=1)):
+                print(path, label, score)
+
+    for f in stream_files:
+        f.close()
+        print('Writing:', f.name)
+
+    output_scores = np.concatenate(output_scores) if output_scores else np.zeros((0,len(classes or [])),np.float32)
+    class_labels = classes or [str(idx) for idx in range(output_scores.shape[1])]
+    for outfile in outfiles:
+        if outfile in streamed: continue
+        print('Writing:', outfile)
+        save_run_results(input_images, output_scores, class_labels, timestamp, args.outdir,
+                         os.path.relpath(outfile, args.outdir), model_id=model_id, input_obj=args.SRC)
 
 
 if __name__ == '__main__':
@@ -109,23 +271,59 @@ if __name__ == '__main__':
     subparsers = parser.add_subparsers(dest='cmd_mode', help='These sub-commands are mutually exclusive.')
     export = subparsers.add_parser('EXPORT', help='Export a .ptl model to .onnx')
     run = subparsers.add_parser('RUN', help='Run an onnx model')
+    compare = subparsers.add_parser('COMPARE', help='Compare the accuracy and latency of an FP32 onnx model and its quantized export')
 
     # EXPORT from .ptl
     export.add_argument('MODEL', help='Model .ptl file to convert')
-    export.add_argument('--half', action='store_true', help='Exports model using 16bit floating point precision')
+    export.add_argument('--half', action='store_true', help='Exports model using 16bit floating point precision. This does not speed up CPU inference, see --quantize')
     export.add_argument('--device', default='cpu', choices=('cpu','cuda'), help='Device to load model and tensors to. Default is "cpu"')
-    export.add_argument('--opset', default=9, type=int, help='Opset Version for onnx. Default is 9.')
+    export.add_argument('--opset', default=None, type=int, help='Opset Version for onnx. Default is 9, or 13 with --quantize.')
     export.add_argument('--output', default=None, help='Same as model file but with ".ptl" replaced with ".onnx"')
+    export.add_argument('--quantize', choices=('dynamic','static'), help='Also export an INT8 quantized model, as MODEL.INT8.onnx. "static" is calibrated on --calibration images and is the faster of the two for convolutional models. Requires --opset 13 or later, the default when quantizing')
+    export.add_argument('--calibration', metavar='SRC', help='Image list, directory or frame archive used to calibrate --quantize static, eg a training list from generate_training_lists.py')
+    export.add_argument('--calibration-size', metavar='N', default=500, type=int, help='Number of images, sampled from --calibration, to calibrate on. Default is 500')
+    export.add_argument('--batch', dest='batch_size', metavar='SIZE', default=32, type=int, help='Number of calibration images per batch. Default is 32')
+    export.add_argument('--loaders', metavar='N', default=4, type=int, help='Number of calibration data-loading processes. Default is 4')
 
     # RUN onnx
     run.add_argument('MODEL', help='onnx model file')
     run.add_argument('SRC', help='file to run the model on')
     run.add_argument('--classfile','-c', help='file with list of class labels')
+    run.add_argument('--outdir', default='.', help='Default is the current directory')
+    run.add_argument('--outfile', action='append', help='Results file, .json .mat .h5 or .csv, as with neuston_net.py RUN. May be given more than once. By default results are printed')
+    run.add_argument('--batch', dest='batch_size', metavar='SIZE', default=108, type=int, help='Number of images per batch. Default is 108')
+    run.add_argument('--loaders', metavar='N', default=4, type=int, help='Number of data-loading processes. Default is 4')
+    run.add_argument('--draft', action='store_true', help='Decode JPEGs at a reduced scale, close to the model input size, before resizing')
+    run.add_argument('--intra-threads', metavar='N', default=0, type=int, help='onnxruntime threads within an operator. Default 0 lets onnxruntime decide')
+    run.add_argument('--inter-threads', metavar='N', default=0, type=int, help='onnxruntime threads across operators. Default 0 lets onnxruntime decide')
+    run.add_argument('--graph-opt', default='all', choices=('disable','basic','extended','all'), help='onnxruntime graph optimization level. Default is "all"')
+
+    # COMPARE fp32 and quantized onnx
+    compare.add_argument('MODEL', help='FP32 onnx model file')
+    compare.add_argument('QUANTIZED', help='Quantized onnx model file, eg from EXPORT --quantize')
+    compare.add_argument('SRC', help='Held-out image list (or directory) with yolo label files alongside, eg a test list from generate_training_lists.py')
+    compare.add_argument('--outfile', help='Write the report to this .json file as well')
+    compare.add_argument('--batch', dest='batch_size', metavar='SIZE', default=108, type=int, help='Number of images per batch. Default is 108')
+    compare.add_argument('--loaders', metavar='N', default=4, type=int, help='Number of data-loading processes. Default is 4')
+    compare.add_argument('--draft', action='store_true', help='Decode JPEGs at a reduced scale, close to the model input size, before resizing')
+    compare.add_argument('--intra-threads', metavar='N', default=0, type=int, help='onnxruntime threads within an operator. Default 0 lets onnxruntime decide')
+    compare.add_argument('--inter-threads', metavar='N', default=0, type=int, help='onnxruntime threads across operators. Default 0 lets onnxruntime decide')
+    compare.add_argument('--graph-opt', default='all', choices=('disable','basic','extended','all'), help='onnxruntime graph optimization level. Default is "all"')
 
     args = parser.parse_args()
 
     if args.cmd_mode=='EXPORT':
+        if args.quantize and args.half:
+            parser.error('--quantize and --half are mutually exclusive')
+        if args.quantize=='static' and not args.calibration:
+            parser.error('--quantize static requires --calibration')
+        if args.opset is None:
+            args.opset = 13 if args.quantize else 9
+        elif args.quantize and args.opset < 13:
+            parser.error('--quantize requires --opset 13 or later')  # per-channel QDQ quantization
         do_export(args)
+    elif args.cmd_mode=='COMPARE':
+        do_compare(args)
     else: # RUN
         do_run(args)
 
@@ -16,7 +16,7 @@ def calc_img_norm(args):
 
     with open(args.SRC) as f:
         filelist = [line.strip() for line in f.readlines()]
-    dataset = HerringrunnerDataset(filelist, resize=args.resize)
+    dataset = HerringrunnerDataset(filelist, resize=args.resize, draft=args.draft)
     dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=4)
     num_batches = len(dataloader)
 
@@ -68,6 +68,7 @@ if __name__ == '__main__':
     imgnorm.add_argument('SRC')
     imgnorm.add_argument('--resize', metavar='N', default=299, type=int, choices=[224,299], help='Default is 299 (for inception_v3)')
     imgnorm.add_argument('--batch-size', metavar='B', default=108, help='Number of images per minibatch')
+    imgnorm.add_argument('--draft', action='store_true', help='Decode JPEGs at a reduced scale, close to --resize, before resizing')
 
     # run util command
     args = parser.parse_args()
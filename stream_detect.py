@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+#
+# Streams preprocessed frames from process_video.py straight into a yolov5
+# detector, without writing frames to disk and reading them back. Per-frame
+# fish counts are written to a single csv, in the same format that
+# detect_summary.py produces from a directory of label files.
+#
+import os
+import queue
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+import torch
+
+import detect_summary
+import process_video
+
+YOLO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'yolov5_ultralytics')
+if YOLO_ROOT not in sys.path:
+    sys.path.append(YOLO_ROOT)
+
+from models.common import DetectMultiBackend
+from utils.augmentations import letterbox
+from utils.general import check_img_size, non_max_suppression
+from utils.torch_utils import select_device
+
+
+def argument_parser():
+    parser = process_video.argument_parser()
+
+    group = parser.add_argument_group('streaming detection')
+    group.add_argument('--weights', required=True, help='yolov5 model path, eg best.pt')
+    group.add_argument('--imgsz', '--img', '--img-size', nargs='+', type=int, default=[640], help='inference size h,w')
+    group.add_argument('--conf-thres', type=float, default=0.25, help='confidence threshold')
+    group.add_argument('--iou-thres', type=float, default=0.45, help='NMS IoU threshold')
+    group.add_argument('--max-det', type=int, default=1000, help='maximum detections per image')
+    group.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    group.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
+    group.add_argument('--queue-size', type=int, default=32,
+                       help='maximum number of preprocessed frames waiting for the detector. Default is 32')
+    group.add_argument('--outdir', '-o', required=True)
+    group.add_argument('--outfile', help='Default is VIDEONAME.csv')
+    group.add_argument('--metadata', action='store_true', help='add cloudcat, daycat and mooncat columns (see detect_summary.py)')
+
+    return parser
+
+
+# Sentinel put on the queue by each producer when its work unit is finished
+DONE = object()
+
+
+def producer_main(args, n, workunit, frames_queue):
+    try:
+        args = process_video.use_device(args, (args.backend, n))
+        for nf, timestamp, out, output in process_video.preprocess_frames(args, n, workunit):
+            frames_queue.put((nf, os.path.basename(out), output))
+    except BaseException as e:
+        frames_queue.put(e)
+    finally:
+        frames_queue.put(DONE)
+
+
+@torch.no_grad()
+def main(args):
+    # Validate our settings
+    outopts = [args.save_original, args.save_preprocessed]
+    assert all(os.path.isdir(x) for x in outopts if x is not None)
+    args.save_detection_data = args.save_detection_image = None
+
+    video_name, _ = os.path.splitext(os.path.basename(args.video))
+    outfile = os.path.join(args.outdir, args.outfile or video_name + '.csv')
+    os.makedirs(args.outdir, exist_ok=True)
+
+    # Load model
+    device = select_device(args.device)
+    model = DetectMultiBackend(args.weights, device=device)
+    stride, pt, jit, engine = model.stride, model.pt, model.jit, model.engine
+    imgsz = args.imgsz * 2 if len(args.imgsz) == 1 else args.imgsz
+    imgsz = check_img_size(imgsz, s=stride)
+    half = args.half and (pt or jit or engine) and device.type != 'cpu'
+    if pt or jit:
+        model.model.half() if half else model.model.float()
+    model.warmup(imgsz=(1, 3, *imgsz), half=half)
+
+    tempdir, nframes = process_video.prepare_video(args)
+    workunits = process_video.plan_workunits(args, nframes)
+
+    # Each work unit is preprocessed on its own thread. The bounded queue
+    # applies back-pressure if the detector falls behind.
+    frames_queue = queue.Queue(maxsize=args.queue_size)
+    producers = [threading.Thread(target=producer_main, args=(args, n, wu, frames_queue), daemon=True)
+                 for n, wu in enumerate(workunits)]
+    for producer in producers:
+        producer.start()
+
+    rows, running, gated = [], len(producers), 0
+    while running:
+        item = frames_queue.get()
+        if item is DONE:
+            running -= 1
+            continue
+        elif isinstance(item, BaseException):
+            raise item
+        nf, frame_id, output = item
+
+        # Frames closed by --motion-gate are counted as empty without running the detector
+        if process_video.motion_gated(args, output):
+            rows.append((nf, frame_id, video_name, 0))
+            gated += 1
+            continue
+
+        # `output` is a BGR image, exactly as cv2.imread would have loaded it
+        im = letterbox(output, imgsz, stride=stride, auto=pt)[0]
+        im = np.ascontiguousarray(im.transpose((2, 0, 1))[::-1])  # HWC to CHW, BGR to RGB
+        im = torch.from_numpy(im).to(device)
+        im = im.half() if half else im.float()
+        im = im[None] / 255
+
+        pred = model(im)
+        pred = non_max_suppression(pred, args.conf_thres, args.iou_thres, max_det=args.max_det)
+        rows.append((nf, frame_id, video_name, len(pred[0])))
+
+    for producer in producers:
+        producer.join()
+    process_video.join_archives(args, workunits)
+    del tempdir
+    if args.motion_gate is not None:
+        print(f'--motion-gate skipped the detector on {gated} of {len(rows)} frames')
+
+    # Same columns as detect_summary.create_df_from_labels
+    rows.sort()
+    df = pd.DataFrame([r[1:] for r in rows], columns=['frame', 'video', 'count'])
+    df.set_index('frame', inplace=True)
+
+    if args.metadata:
+        df = detect_summary.add_metadata(df)
+        df.sort_values(by='ts', inplace=True)
+
+    print('Writing:', outfile)
+    detect_summary.quote_video(df).to_csv(outfile)
+
+
+if __name__ == '__main__':
+    parser = argument_parser()
+    args = parser.parse_args()
+    if not args.video:
+        parser.error('Error: --video is required')
+    if args.afr and args.frame_list:
+        parser.error('Error: --afr and --frame-list are mutually exclusive')
+    main(args)
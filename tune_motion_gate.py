@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+#
+# Tunes the --motion-gate threshold of process_video.py, stream_detect.py and
+# yolov5_ultralytics/detect.py against labelled frames, eg the training.txt,
+# validation.txt and test.txt lists written by generate_training_lists.py.
+#
+# The listed images must be preprocessed frames (process_video.py
+# --save-preprocessed), whose green channel is the background subtraction mask.
+# For each candidate threshold, this reports how many frames the gate would
+# skip, and how many frames with fish, and fish, it would miss. The suggested
+# threshold is the largest that misses at most --max-miss of the frames with
+# fish. generate_training_lists.py keeps only some frames without fish
+# (--neg-ratio), so the share of frames skipped in a full video is higher than
+# the share skipped in its lists.
+#
+import argparse
+import os
+from multiprocessing.pool import ThreadPool
+
+import cv2 as cv
+import numpy as np
+import pandas as pd
+
+import label_manifest
+from preprocess_engines import foreground_fraction
+
+
+def label_for_image(image_file):
+    return os.path.splitext(image_file)[0].replace('images/','labels/') + '.txt'
+
+
+def read_list(list_file):
+    with open(list_file) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+# Fish count of each image, from the label manifest where it has the image and
+# otherwise from its label file. Images without labels are left out.
+def fish_counts(image_files, manifest_file=None):
+    known = {}
+    if manifest_file:
+        manifest = label_manifest.load(manifest_file)
+        known = dict(zip(manifest['image_file'].tolist(), manifest['count'].tolist()))
+
+    counts = {}
+    for image_file in image_files:
+        if image_file in known:
+            counts[image_file] = known[image_file]
+        elif os.path.isfile(label_for_image(image_file)):
+            counts[image_file] = label_manifest.read_label(label_for_image(image_file))[0]
+    return counts
+
+
+def measure(image_file):
+    image = cv.imread(image_file)
+    if image is None:
+        print('error:', image_file)
+        return np.nan
+    return foreground_fraction(image)
+
+
+def gate_report(df, thresholds):
+    fish = df['count'] > 0
+    rows = []
+    for threshold in thresholds:
+        gated = df['foreground'] < threshold
+        rows.append(dict(
+            threshold=threshold,
+            gated_frames=gated.mean(),
+            missed_fish_frames=(gated & fish).sum() / max(fish.sum(), 1),
+            missed_fish=df['count'][gated].sum() / max(df['count'].sum(), 1),
+            gated_empty_frames=(gated & ~fish).sum() / max((~fish).sum(), 1),
+        ))
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('LIST', nargs='+', help='text files listing preprocessed images with yolo labels alongside, eg from generate_training_lists.py')
+    parser.add_argument('--manifest', help='label manifest to take fish counts from, eg SRC/.label_manifest.npz from generate_training_lists.py')
+    parser.add_argument('--thresholds', nargs='+', type=float, default=list(np.geomspace(1e-5, 0.1, 17)),
+                        help='foreground fractions to evaluate. Default is 17 steps from 0.00001 to 0.1')
+    parser.add_argument('--max-miss', type=float, default=0.01, help='largest fraction of frames with fish that the suggested threshold may skip. Default is 0.01')
+    parser.add_argument('--workers', type=int, default=16, help='threads reading images. Default is 16')
+    parser.add_argument('--outfile', help='csv of the count and foreground fraction of every frame')
+    args = parser.parse_args()
+
+    image_files = sorted({image_file for list_file in args.LIST for image_file in read_list(list_file)})
+    counts = fish_counts(image_files, args.manifest)
+    if len(counts) < len(image_files):
+        print(f'{len(image_files)-len(counts)} images without labels were omitted')
+    image_files = [image_file for image_file in image_files if image_file in counts]
+
+    with ThreadPool(args.workers) as pool:
+        fractions = pool.map(measure, image_files, chunksize=64)
+
+    df = pd.DataFrame(dict(frame=[os.path.splitext(os.path.basename(f))[0] for f in image_files],
+                           count=[counts[f] for f in image_files],
+                           foreground=fractions))
+    df = df.dropna()
+    if args.outfile:
+        print('Writing:', args.outfile)
+        df.to_csv(args.outfile, index=False)
+
+    fish = df['count'] > 0
+    print(f'{len(df)} frames, {fish.sum()} with fish')
+    if fish.any():
+        print('foreground fraction of frames with fish: min {:.6f}, 1% {:.6f}, median {:.6f}'.format(
+            *df['foreground'][fish].quantile([0, 0.01, 0.5])))
+
+    report = gate_report(df, sorted(args.thresholds))
+    print(report.to_string(index=False, float_format='{:.6f}'.format))
+
+    ok = report[report['missed_fish_frames'] <= args.max_miss]
+    if len(ok):
+        best = ok.iloc[-1]
+        print(f'Suggested --motion-gate {best.threshold:.6g}: skips {best.gated_frames:.1%} of frames, '
+              f'misses {best.missed_fish_frames:.2%} of frames with fish')
+    else:
+        print(f'No threshold misses at most {args.max_miss:.2%} of frames with fish')
@@ -0,0 +1,126 @@
+#
+# Weather and moon metadata lookups for detection results, shared by
+# detect_summary.py and agg_multi.py.
+#
+# The visualcrossing.com hourly and daily weather csvs are parsed once into
+# sorted, deduplicated arrays, which are cached in an npz file next to the
+# hourly csv, keyed by a hash of both csvs. Bulk queries for many timestamps are
+# answered with np.searchsorted. Where the csvs have duplicate timestamps, the
+# first instance is used.
+#
+import hashlib
+import os
+import uuid
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+
+HOURLY_COLUMNS = ['temp', 'solarradiation', 'precip', 'cloudcover']
+DAILY_COLUMNS = ['moonphase', 'sunrise', 'sunset']
+CACHE_VERSION = 1
+
+
+def file_hash(*paths):
+    sha = hashlib.sha1(str(CACHE_VERSION).encode())
+    for path in paths:
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()[:16]
+
+
+def build_store(hourly_csv, daily_csv):
+    hourly = pd.read_csv(hourly_csv, index_col='datetime', parse_dates=['datetime'])
+    daily = pd.read_csv(daily_csv, index_col='datetime', parse_dates=['datetime', 'sunrise', 'sunset'])
+    hourly = hourly[~hourly.index.duplicated()].sort_index()
+    daily = daily[~daily.index.duplicated()].sort_index()
+
+    store = dict(hours=hourly.index.to_numpy(dtype='datetime64[ns]'),
+                 days=daily.index.to_numpy(dtype='datetime64[ns]'))
+    for col in HOURLY_COLUMNS:
+        store[col] = hourly[col].to_numpy(dtype=float)
+    store['moonphase'] = daily['moonphase'].to_numpy(dtype=float)
+    store['sunrise'] = daily['sunrise'].to_numpy(dtype='datetime64[ns]')
+    store['sunset'] = daily['sunset'].to_numpy(dtype='datetime64[ns]')
+    return store
+
+
+# Loads the weather store for the given csvs, from the cache if the csvs are
+# unchanged since it was written
+def load_weather(hourly_csv='weather-hourly.csv', daily_csv='weather-daily.csv'):
+    cache_file = os.path.join(os.path.dirname(hourly_csv),
+                              f'.weather-{file_hash(hourly_csv, daily_csv)}.npz')
+    try:
+        with np.load(cache_file) as cached:
+            return dict(cached)
+    except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+        pass
+
+    # The cache is written to a temporary file and renamed into place, so that
+    # concurrent jobs never read a partly written cache
+    store = build_store(hourly_csv, daily_csv)
+    tmp_file = f'{cache_file}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, **store)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        # read-only weather directory, the cache is only an optimization
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return store
+
+
+def _take(keys, values, query, missing):
+    idx = np.searchsorted(keys, query)
+    idx_clipped = np.minimum(idx, len(keys) - 1)
+    found = (idx < len(keys)) & (keys[idx_clipped] == query)
+    return np.where(found, values[idx_clipped], missing)
+
+
+# Returns a DataFrame of the weather at each of the timestamps `ts`: the
+# HOURLY_COLUMNS of its hour and the DAILY_COLUMNS of its day. Timestamps
+# without weather get NaN (or NaT).
+def lookup(store, ts):
+    ts = pd.DatetimeIndex(ts)
+    hours = ts.floor('H').to_numpy(dtype='datetime64[ns]')
+    days = ts.normalize().to_numpy(dtype='datetime64[ns]')
+
+    results = {}
+    for col in HOURLY_COLUMNS:
+        results[col] = _take(store['hours'], store[col], hours, np.nan)
+    results['moonphase'] = _take(store['days'], store['moonphase'], days, np.nan)
+    for col in ['sunrise', 'sunset']:
+        results[col] = _take(store['days'], store[col], days, np.datetime64('NaT'))
+    return pd.DataFrame(results)
+
+
+# cloudcover percent --> category. bins are [lower,upper), missing values are left empty
+CLOUDCATS = np.array(['clear', 'partly-cloudy', 'mostly-cloudy', 'overcast'])
+def cloudcat(cloudcover):
+    cloudcover = np.asarray(cloudcover, dtype=float)
+    cats = CLOUDCATS[np.searchsorted([0.33, 0.66, 0.88], cloudcover / 100, side='right')]
+    return np.where(np.isnan(cloudcover), '', cats)
+
+
+# moonphase fraction --> category, in eighths. missing values are left empty
+MOONCATS = np.array(['new', 'crescent', 'quarter', 'gibbous', 'full', 'gibbous', 'quarter', 'crescent'])
+def mooncat(moonphase):
+    moonphase = np.asarray(moonphase, dtype=float)
+    cats = MOONCATS[np.searchsorted(12.5 * np.arange(1, 8), moonphase * 100, side='right')]
+    return np.where(np.isnan(moonphase), '', cats)
+
+
+# daylight is split into equal segments between sunrise and sunset, anything else is night.
+# days without sunrise or sunset are left empty
+DAYCATS = np.array(['night', '   morning', '  late-morning', ' noon', 'afternoon', 'late-afternoon', 'night'])
+def daycat(ts, sunrise, sunset):
+    sunrise = np.asarray(sunrise, dtype='datetime64[ns]')
+    sunset = np.asarray(sunset, dtype='datetime64[ns]')
+    known = ~(np.isnat(sunrise) | np.isnat(sunset))
+    sunseg = np.where(known, sunset - sunrise, np.timedelta64(1, 'ns')) / (len(DAYCATS) - 2)
+    sincerise = np.where(known, np.asarray(ts, dtype='datetime64[ns]') - sunrise, np.timedelta64(0, 'ns'))
+    seg = np.where(sincerise < np.timedelta64(0), 0, sincerise // sunseg + 1)
+    cats = DAYCATS[np.minimum(seg, len(DAYCATS) - 1).astype(int)]
+    return np.where(known, cats, '')
@@ -18,6 +18,8 @@ import sys
 from pathlib import Path
 
 import cv2
+import numpy as np
+import pandas as pd
 import torch
 import torch.backends.cudnn as cudnn
 
@@ -28,7 +30,8 @@ if str(ROOT) not in sys.path:
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
 from models.common import DetectMultiBackend
-from utils.datasets import IMG_FORMATS, VID_FORMATS, LoadImages, LoadStreams
+from utils.datasets import (IMG_FORMATS, VID_FORMATS, LoadImageBatches, LoadImages, LoadStreams,
+                            PrefetchImages)
 from utils.general import (LOGGER, check_file, check_img_size, check_imshow, check_requirements, colorstr,
                            increment_path, non_max_suppression, print_args, scale_coords, strip_optimizer, xyxy2xywh)
 from utils.plots import Annotator, colors, save_one_box
@@ -62,6 +65,13 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
         save_null_txt=False, # creates a file for every frame, even if there were no detections in a given frame. SBatchelder 2022-09-23
+        batch_size=1,  # batch size for image sources
+        prefetch=0,  # number of images to decode ahead of inference, 0 to disable
+        prefetch_workers=4,  # number of threads decoding images when prefetching
+        pin_memory=False,  # copy images to the device through a pinned-memory staging buffer
+        save_csv=False,  # save all results to one detections/VIDEO.csv per video, including frames without detections
+        save_parquet=False,  # save all results to one detections/VIDEO.parquet per video
+        motion_gate=None,  # skip inference on preprocessed frames with less foreground than this fraction
         ):
     source = str(source)
     save_img = not nosave and not source.endswith('.txt')  # save inference images
@@ -95,14 +105,33 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
     else:
         dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt)
         bs = 1  # batch_size
+        if prefetch > 0 and not any(dataset.video_flag):
+            dataset = PrefetchImages(dataset, depth=prefetch, workers=prefetch_workers)
+        if batch_size > 1 and not any(dataset.video_flag):
+            dataset = LoadImageBatches(dataset, batch_size=batch_size)
+            bs = batch_size
+    batched = isinstance(dataset, LoadImageBatches)
     vid_path, vid_writer = [None] * bs, [None] * bs
+    pin_memory &= device.type != 'cpu'
+    staging = None  # pinned host buffer, reused while the input shape is unchanged
+    rows = []  # (frame, class, x, y, w, h, conf) detections for --save-csv/--save-parquet, class None for null frames
 
     # Run inference
-    model.warmup(imgsz=(1, 3, *imgsz), half=half)  # warmup
-    dt, seen = [0.0, 0.0, 0.0], 0
+    model.warmup(imgsz=(1 if pt else bs, 3, *imgsz), half=half)  # warmup
+    dt, seen, n_gated = [0.0, 0.0, 0.0], 0, 0
     for path, im, im0s, vid_cap, s in dataset:
-        t1 = time_sync()
-        im = torch.from_numpy(im).to(device)
+        gated = None  # per image, True if closed by --motion-gate
+        if motion_gate is not None:
+            gated = [foreground_fraction(x) < motion_gate for x in (im0s if webcam or batched else [im0s])]
+            n_gated += sum(gated)
+        t1 = time_sync()  # also waits for the previous non_blocking copy out of the staging buffer
+        if pin_memory:
+            if staging is None or staging.shape != im.shape:
+                staging = torch.empty(im.shape, dtype=torch.uint8).pin_memory()
+            staging.copy_(torch.from_numpy(im))
+            im = staging.to(device, non_blocking=True)
+        else:
+            im = torch.from_numpy(im).to(device)
         im = im.half() if half else im.float()  # uint8 to fp16/32
         im /= 255  # 0 - 255 to 0.0 - 1.0
         if len(im.shape) == 3:
@@ -110,25 +139,34 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
         t2 = time_sync()
         dt[0] += t2 - t1
 
-        # Inference
-        visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if visualize else False
-        pred = model(im, augment=augment, visualize=visualize)
-        t3 = time_sync()
-        dt[1] += t3 - t2
+        # Inference, unless every image is closed by --motion-gate
+        if gated and all(gated):
+            pred = [torch.zeros((0, 6), device=device) for _ in gated]
+            t3 = time_sync()
+        else:
+            visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if visualize and not batched else False
+            pred = model(im, augment=augment, visualize=visualize)
+            t3 = time_sync()
+            dt[1] += t3 - t2
 
-        # NMS
-        pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
-        dt[2] += time_sync() - t3
+            # NMS
+            pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
+            dt[2] += time_sync() - t3
+            if gated:  # gated images in a batch that was inferred have no detections either
+                pred = [det[:0] if g else det for det, g in zip(pred, gated)]
 
         # Second-stage classifier (optional)
         # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
 
         # Process predictions
+        ss = s  # per-image print strings, when batched
         for i, det in enumerate(pred):  # per image
             seen += 1
             if webcam:  # batch_size >= 1
                 p, im0, frame = path[i], im0s[i].copy(), dataset.count
                 s += f'{i}: '
+            elif batched:  # batch_size >= 1
+                p, im0, frame, s = path[i], im0s[i].copy(), 0, ss[i]
             else:
                 p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
 
@@ -145,18 +183,24 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
                 # Rescale boxes from img_size to im0 size
                 det[:, :4] = scale_coords(im.shape[2:], det[:, :4], im0.shape).round()
 
+                if save_csv or save_parquet:  # buffer normalized xywh labels for the whole run
+                    d = det.cpu()
+                    xywh = (xyxy2xywh(d[:, :4]) / gn).tolist()
+                    frame_id = Path(txt_path).name
+                    rows += [(frame_id, int(c), *b, float(cf)) for b, cf, c in zip(xywh, d[:, 4], d[:, 5])]
+
                 # Print results
                 for c in det[:, -1].unique():
                     n = (det[:, -1] == c).sum()  # detections per class
                     s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
 
                 # Write results
+                lines = []  # label file lines, written with a single open()
                 for *xyxy, conf, cls in reversed(det):
                     if save_txt:  # Write to file
                         xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
                         line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                        with open(txt_path + '.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
+                        lines.append(('%g ' * len(line)).rstrip() % line + '\n')
 
                     if save_img or save_crop or view_img:  # Add bbox to image
                         c = int(cls)  # integer class
@@ -164,6 +208,12 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
                         annotator.box_label(xyxy, label, color=colors(c, True))
                         if save_crop:
                             save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
+                if lines:
+                    with open(txt_path + '.txt', 'a') as f:
+                        f.writelines(lines)
+
+            elif save_csv or save_parquet:
+                rows.append((Path(txt_path).name, None, None, None, None, None, None))  # null frame
 
             # Print time (inference-only)
             LOGGER.info(f'{s}Done. ({t3 - t2:.3f}s)')
@@ -196,6 +246,10 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
     # Print results
     t = tuple(x / seen * 1E3 for x in dt)  # speeds per image
     LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {(1, 3, *imgsz)}' % t)
+    if motion_gate is not None:
+        LOGGER.info(f'--motion-gate skipped inference on {n_gated} of {seen} images')
+    if save_csv or save_parquet:
+        write_detections(rows, save_dir / 'detections', save_csv, save_parquet)
     if save_txt or save_img:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
         LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}{s}")
@@ -203,10 +257,31 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
         strip_optimizer(weights)  # update model (to fix SourceChangeWarning)
 
 
+# Fraction of the pixels of a process_video.py preprocessed frame that are
+# foreground in its green channel, the background subtraction mask. The same as
+# preprocess_engines.foreground_fraction.
+def foreground_fraction(im0):
+    mask = im0[..., 1]
+    return np.count_nonzero(mask > 127) / mask.size
+
+
+def write_detections(rows, save_dir, save_csv=True, save_parquet=False):
+    # Write buffered detections to one columnar file per video, frames named VIDEO_MSEC
+    df = pd.DataFrame(rows, columns=['frame', 'class', 'x', 'y', 'w', 'h', 'conf'])
+    df['class'] = df['class'].astype('Int64')  # nullable, None for frames without detections
+    save_dir.mkdir(parents=True, exist_ok=True)
+    for video, dfv in df.groupby(df['frame'].str.rsplit('_', n=1).str[0], sort=False):
+        if save_csv:
+            dfv.to_csv(save_dir / f'{video}.csv', index=False)
+        if save_parquet:
+            dfv.to_parquet(save_dir / f'{video}.parquet', index=False)
+    LOGGER.info(f"{len(df)} detection rows saved to {colorstr('bold', save_dir)}")
+
+
 def parse_opt():
     parser = argparse.ArgumentParser()
     parser.add_argument('--weights', nargs='+', type=str, default=ROOT / 'yolov5s.pt', help='model path(s)')
-    parser.add_argument('--source', type=str, default=ROOT / 'data/images', help='file/dir/URL/glob, 0 for webcam')
+    parser.add_argument('--source', type=str, default=ROOT / 'data/images', help='file/dir/URL/glob/frame .zip, 0 for webcam')
     parser.add_argument('--imgsz', '--img', '--img-size', nargs='+', type=int, default=[640], help='inference size h,w')
     parser.add_argument('--conf-thres', type=float, default=0.25, help='confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.45, help='NMS IoU threshold')
@@ -231,6 +306,13 @@ def parse_opt():
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
     parser.add_argument('--save-null-txt', action='store_true', help='when saving results to *.txt, include frames without detections')  # SBatchelder 2022-09-23
+    parser.add_argument('--batch-size', type=int, default=1, help='batch size for image sources, same-shape images are inferred together')
+    parser.add_argument('--prefetch', type=int, default=0, help='number of images to decode ahead of inference, 0 to disable')
+    parser.add_argument('--prefetch-workers', type=int, default=4, help='number of threads decoding images when prefetching')
+    parser.add_argument('--pin-memory', action='store_true', help='copy images to the device through a pinned-memory staging buffer')
+    parser.add_argument('--save-csv', action='store_true', help='save results to one detections/VIDEO.csv per video')
+    parser.add_argument('--save-parquet', action='store_true', help='save results to one detections/VIDEO.parquet per video')
+    parser.add_argument('--motion-gate', type=float, metavar='FRACTION', help='skip inference on process_video.py preprocessed frames whose foreground mask covers less than FRACTION of the frame')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     print_args(FILE.stem, opt)
@@ -6,10 +6,12 @@ Dataloaders and dataset utils
 import glob
 import hashlib
 import json
+import math
 import os
 import random
 import shutil
 import time
+from collections import deque
 from itertools import repeat
 from multiprocessing.pool import Pool, ThreadPool
 from pathlib import Path
@@ -159,7 +161,11 @@ class LoadImages:
     # YOLOv5 image/video dataloader, i.e. `python detect.py --source image.jpg/vid.mp4`
     def __init__(self, path, img_size=640, stride=32, auto=True):
         p = str(Path(path).resolve())  # os-agnostic absolute path
-        if '*' in p:
+        self.archive = None
+        if os.path.isfile(p) and p.endswith('.zip'):  # frame archive from process_video.py --archive
+            self.archive = ZipFile(p)
+            files = sorted(os.path.join(p, x) for x in self.archive.namelist())  # i.e. VIDEONAME.zip/VIDEONAME_1234.jpg
+        elif '*' in p:
             files = sorted(glob.glob(p, recursive=True))  # glob
         elif os.path.isdir(p):
             files = sorted(glob.glob(os.path.join(p, '*.*')))  # dir
@@ -218,19 +224,19 @@ class LoadImages:
         else:
             # Read image
             self.count += 1
-            img0 = cv2.imread(path)  # BGR
+            img0 = self.imread(path)  # BGR
             assert img0 is not None, f'Image Not Found {path}'
             s = f'image {self.count}/{self.nf} {path}: '
 
-        # Padded resize
-        img = letterbox(img0, self.img_size, stride=self.stride, auto=self.auto)[0]
-
-        # Convert
-        img = img.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
-        img = np.ascontiguousarray(img)
-
+        img = letterbox_chw(img0, self.img_size, stride=self.stride, auto=self.auto)
         return path, img, img0, self.cap, s
 
+    def imread(self, path):
+        if self.archive:  # archive member, looked up in the zip central directory
+            buf = self.archive.read(path[len(self.archive.filename) + 1:])
+            return cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_COLOR)  # BGR
+        return cv2.imread(path)  # BGR
+
     def new_video(self, path):
         self.frame = 0
         self.cap = cv2.VideoCapture(path)
@@ -240,6 +246,99 @@ class LoadImages:
         return self.nf  # number of files
 
 
+def letterbox_chw(img0, img_size=640, stride=32, auto=True):
+    # Padded resize
+    img = letterbox(img0, img_size, stride=stride, auto=auto)[0]
+
+    # Convert
+    img = img.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
+    return np.ascontiguousarray(img)
+
+
+class PrefetchImages:
+    # YOLOv5 prefetching image dataloader, i.e. `python detect.py --source path/ --prefetch 16`
+    # Decodes and letterboxes up to `depth` LoadImages images ahead on a thread pool, yielding them in order
+    def __init__(self, dataset, depth=16, workers=NUM_THREADS):
+        assert not any(dataset.video_flag), 'PrefetchImages does not support video sources'
+        self.files = dataset.files
+        self.nf = dataset.nf  # number of files
+        self.video_flag = dataset.video_flag
+        self.img_size = dataset.img_size
+        self.stride = dataset.stride
+        self.auto = dataset.auto
+        self.imread = dataset.imread
+        self.mode = 'image'
+        self.depth = max(depth, 1)
+        self.pool = ThreadPool(workers)  # cv2 releases the GIL while decoding and resizing
+
+    def load(self, path):
+        img0 = self.imread(path)  # BGR
+        assert img0 is not None, f'Image Not Found {path}'
+        return path, letterbox_chw(img0, self.img_size, stride=self.stride, auto=self.auto), img0
+
+    def submit(self):
+        if self.submitted < self.nf:
+            self.pending.append(self.pool.apply_async(self.load, (self.files[self.submitted],)))
+            self.submitted += 1
+
+    def __iter__(self):
+        self.count = 0
+        self.submitted = 0
+        self.pending = deque()  # AsyncResults, in file order
+        for _ in range(self.depth):
+            self.submit()
+        return self
+
+    def __next__(self):
+        if not self.pending:
+            raise StopIteration
+        path, img, img0 = self.pending.popleft().get()
+        self.submit()
+        self.count += 1
+        s = f'image {self.count}/{self.nf} {path}: '
+        return path, img, img0, None, s
+
+    def __len__(self):
+        return self.nf  # number of files
+
+
+class LoadImageBatches:
+    # YOLOv5 batched image dataloader, i.e. `python detect.py --source path/ --batch-size 32`
+    # Collates consecutive LoadImages images that letterbox to the same shape into a single batch
+    def __init__(self, dataset, batch_size=32):
+        assert not any(dataset.video_flag), 'LoadImageBatches does not support video sources'
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.nf = dataset.nf  # number of files
+        self.mode = 'image'
+
+    def __iter__(self):
+        self.images = iter(self.dataset)
+        self.pending = None  # first image of the next batch, if it did not match the current batch shape
+        self.count = 0
+        return self
+
+    def __next__(self):
+        batch = [self.pending] if self.pending else []
+        self.pending = None
+        for item in self.images:
+            if batch and item[1].shape != batch[0][1].shape:  # new shape, start a new batch
+                self.pending = item
+                break
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                break
+        if not batch:
+            raise StopIteration
+
+        self.count += len(batch)
+        paths, imgs, img0s, _, s = zip(*batch)
+        return list(paths), np.stack(imgs), list(img0s), None, list(s)
+
+    def __len__(self):
+        return math.ceil(self.nf / self.batch_size)  # minimum number of batches
+
+
 class LoadWebcam:  # for inference
     # YOLOv5 local webcam dataloader, i.e. `python detect.py --source 0`
     def __init__(self, pipe='0', img_size=640, stride=32):